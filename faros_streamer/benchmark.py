@@ -0,0 +1,301 @@
+# This file is part of Faros Streamer.
+#
+# Copyright 2015
+# Andreas Henelius <andreas.henelius@ttl.fi>,
+# Finnish Institute of Occupational Health
+#
+# This code is released under the MIT License
+# http://opensource.org/licenses/mit-license.php
+#
+# Please see the file LICENSE for details.
+
+from .libfaros import *
+from .utilities import *
+from .simulator import make_packet
+import argparse
+import itertools
+import json
+import platform
+import socket
+import tracemalloc
+
+# -------------------------------------------------------------------------------
+# Benchmarking the streaming code
+# -------------------------------------------------------------------------------
+
+def get_all_settings():
+    """ Return a list of settings strings (see mode_to_str) covering all
+        combinations that change the packet format. The ECG resolution
+        and high-pass filter do not affect the packets and are fixed.
+    """
+    out = []
+    for ecg_n, ecg_fs, rr, acc_fs, temp in itertools.product(['1', '3'],
+                                                             sorted(get_ecg_str_fs().values()),
+                                                             ['0', '1'],
+                                                             sorted(get_acc_str_fs().values()),
+                                                             ['0', '1']):
+        out.append(mode_to_str(ecg_n  = ecg_n,
+                               ecg_fs = ecg_fs,
+                               rr     = rr,
+                               acc_fs = acc_fs,
+                               temp   = temp))
+    return(out)
+
+
+class NullOutlet(object):
+    """ An outlet that discards all data, for timing without LSL. """
+    def push_chunk(self, x, timestamp = 0.0, pushthrough = True):
+        pass
+
+    def push_sample(self, x, timestamp = 0.0, pushthrough = True):
+        pass
+
+
+class TimingOutlet(object):
+    """ Wrap an outlet and record the LSL time of every push_sample. """
+    def __init__(self, outlet):
+        self.outlet = outlet
+        self.times  = []
+
+    def push_chunk(self, x, timestamp = 0.0, pushthrough = True):
+        self.outlet.push_chunk(x, timestamp, pushthrough)
+
+    def push_sample(self, x, timestamp = 0.0, pushthrough = True):
+        self.outlet.push_sample(x, timestamp, pushthrough)
+        self.times.append(local_clock())
+
+
+def create_outlets(layout, settings, lsl = True):
+    """ Create outlets (ECG, acc, marker, RR, temperature) for benchmarking. """
+    if not lsl:
+        return [NullOutlet() if n else None for n in [layout.n_ecg_s, layout.n_acc_s, 1, layout.n_rr_s, layout.n_temp_s]]
+
+    s = unpack_settings('wba' + settings)
+    prefix = 'faros_benchmark_'
+    return [create_lsl_outlet(prefix + 'ecg', 'ECG', layout.n_ecg_c, s['ecg_fs']) if layout.n_ecg_s else None,
+            create_lsl_outlet(prefix + 'acc', 'Acc', 3, s['acc_fs']) if layout.n_acc_s else None,
+            create_lsl_outlet(prefix + 'marker', 'Marker', 1, 0.0),
+            create_lsl_outlet(prefix + 'rr', 'RR', 1, 0.0) if layout.n_rr_s else None,
+            create_lsl_outlet(prefix + 'temp', 'Temp', 1, 5, channel_format = 'float32') if layout.n_temp_s else None]
+
+
+def time_per_packet(f, n_packets, repeat = 5):
+    """ Return the time in microseconds per packet of f(), which
+        processes n_packets packets (best of repeat runs).
+    """
+    best = None
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        f()
+        t  = time.perf_counter() - t0
+        if (best is None) or (t < best):
+            best = t
+    return 1e6 * best / n_packets
+
+
+def benchmark_stages(settings, n_packets = 200, lsl = True):
+    """ Time the stages of handling a packet for the given settings.
+        Returns a dictionary with microseconds per packet for each
+        stage, packets per second for all stages together, the peak of
+        the memory allocated while handling one packet (the median over
+        packets) and the number of memory blocks and bytes per packet
+        still allocated after handling n_packets packets.
+    """
+    layout  = PacketLayout(unpack_settings('wba' + settings))
+    packets = [make_packet(layout, i, marker = 1, rr = 800) for i in range(n_packets)]
+    stream  = bytearray(b''.join(packets))
+    outlets = create_outlets(layout, settings, lsl)
+    framer  = PacketFramer(layout, n_packets + 1)
+
+    def framing():
+        framer.clear()
+        for packet in framer.feed(stream, len(stream)):
+            pass
+
+    def crc():
+        for packet in packets:
+            framer.is_valid(memoryview(packet))
+
+    def decode():
+        counter = PacketCounter()
+        for packet in packets:
+            data = decode_packets(packet, layout).copy()[0]
+            counter.update(int(data['packet_number']))
+
+    records = [decode_packets(packet, layout).copy()[0] for packet in packets]
+
+    def push():
+        for data in records:
+            push_data(data, layout, *outlets, timestamp = local_clock())
+
+    out = OrderedDict()
+    out['settings']     = settings
+    out['packet_size']  = layout.size
+    out['framing_us']   = time_per_packet(framing, n_packets)
+    out['crc_us']       = time_per_packet(crc, n_packets)
+    out['decode_us']    = time_per_packet(decode, n_packets)
+    out['push_us']      = time_per_packet(push, n_packets)
+    out['total_us']     = out['framing_us'] + out['decode_us'] + out['push_us']
+    out['packets_per_s'] = 1e6 / out['total_us']
+    out['realtime_cpu_percent'] = 100.0 * out['total_us'] * 1e-6 / PACKET_DURATION
+
+    # memory allocated while handling packets, after a warm-up so that
+    # memory allocated once (e.g., by the first push) is not counted
+    buffers = [bytearray(x) for x in packets]
+
+    def handle(packet):
+        framer.clear()
+        for p in framer.feed(packet, len(packet)):
+            push_data(decode_packets(p, layout).copy()[0], layout, *outlets, timestamp = local_clock())
+
+    for packet in buffers[0:5]:
+        handle(packet)
+
+    tracemalloc.start()
+    peaks = []
+    for packet in buffers[0:20]:
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        handle(packet)
+        peaks.append(tracemalloc.get_traced_memory()[1] - current)
+
+    snapshot = tracemalloc.take_snapshot()
+    for packet in buffers:
+        handle(packet)
+    diff = tracemalloc.take_snapshot().compare_to(snapshot, 'filename')
+    tracemalloc.stop()
+
+    out['peak_bytes_per_packet']      = int(np.median(peaks))
+    out['retained_blocks_per_packet'] = sum(x.count_diff for x in diff) / n_packets
+    out['retained_bytes_per_packet']  = sum(x.size_diff for x in diff) / n_packets
+
+    return(out)
+
+
+def benchmark_latency(settings, n_packets = 50, speed = 20.0, lsl = True):
+    """ Measure the time from writing a packet into a socket to pushing
+        its data to LSL through a StreamerThread, with packets sent
+        at speed times the real-time rate. Returns latency percentiles
+        in milliseconds.
+    """
+    layout  = PacketLayout(unpack_settings('wba' + settings))
+    outlets = create_outlets(layout, settings, lsl)
+    marker  = TimingOutlet(outlets[2])
+    s1, s2  = socket.socketpair()
+
+    streamer = StreamerThread(False, s1, layout,
+                              outlets[0], outlets[1], marker, outlets[3], outlets[4])
+
+    # answers to wbaoms and wbaom7
+    s2.sendall(b'wbaack\rwbaack\r')
+    streamer.start()
+
+    sent = []
+    for i in range(n_packets):
+        packet = make_packet(layout, i, marker = 1)
+        sent.append(local_clock())
+        s2.sendall(packet)
+        time.sleep(PACKET_DURATION / speed)
+
+    # closing the connection ends the stream
+    s2.shutdown(socket.SHUT_WR)
+    streamer.join(2.0)
+    streamer.sink.join(2.0)
+    s1.close()
+    s2.close()
+
+    n       = min(len(sent), len(marker.times))
+    latency = 1e3 * (np.array(marker.times[0:n]) - np.array(sent[0:n]))
+
+    # latencies are only valid if every packet got through
+    out = OrderedDict()
+    out['latency_packets'] = int(n)
+    out['latency_errors']  = streamer.get_statistics()['crc_errors']
+    if n > 0:
+        out['latency_p50_ms'] = float(np.percentile(latency, 50))
+        out['latency_p90_ms'] = float(np.percentile(latency, 90))
+        out['latency_p99_ms'] = float(np.percentile(latency, 99))
+        out['latency_max_ms'] = float(np.max(latency))
+    return(out)
+
+
+def get_version():
+    """ Return the installed version of Faros Streamer. """
+    try:
+        import pkg_resources
+        return pkg_resources.get_distribution('faros-streamer').version
+    except Exception:
+        return 'unknown'
+
+
+def print_comparison(results, reference):
+    """ Print the change in time per packet compared to an earlier run. """
+    ref = {r['settings'] : r for r in reference['results']}
+    print_header(['Settings', 'Total (us)', 'Reference (us)', 'Change (%)'], pad = 16)
+    for r in results:
+        if r['settings'] in ref:
+            r0 = ref[r['settings']]['total_us']
+            print_header([r['settings'],
+                          '{0:.1f}'.format(r['total_us']),
+                          '{0:.1f}'.format(r0),
+                          '{0:+.1f}'.format(100.0 * (r['total_us'] - r0) / r0)], pad = 16)
+
+
+def benchmark_cli():
+    parser = argparse.ArgumentParser(description = "Benchmark Faros Streamer")
+    parser.add_argument("--settings", dest = "settings", action = "append", help="Settings string to benchmark (see mode_to_str). Can be given several times. Default is all combinations.")
+    parser.add_argument("--packets", dest = "n_packets", type = int, help="Number of packets per timing run. Default is 200.", default = 200)
+    parser.add_argument("--latency-packets", dest = "latency_packets", type = int, help="Number of packets for measuring latency (0 = skip). Default is 50.", default = 50)
+    parser.add_argument("--no-lsl", action = "store_true", dest = "no_lsl", help="Discard the data instead of pushing it to LSL outlets.")
+    parser.add_argument("--output", dest = "output", help="Write the results to this JSON file. Default is faros_benchmark.json.", default = "faros_benchmark.json")
+    parser.add_argument("--compare", dest = "compare", help="Compare the results to an earlier JSON file.")
+
+    args = parser.parse_args()
+
+    if args.settings is None:
+        all_settings = get_all_settings()
+    else:
+        all_settings = args.settings
+
+    lsl     = not args.no_lsl
+    results = []
+
+    print_header(['Settings', 'Size (B)', 'Framing+CRC', 'CRC', 'Decode', 'Push', 'Packets/s', 'Latency p99 (ms)'], pad = 16)
+    for settings in all_settings:
+        r = benchmark_stages(settings, args.n_packets, lsl)
+        if args.latency_packets > 0:
+            r.update(benchmark_latency(settings, args.latency_packets, lsl = lsl))
+        results.append(r)
+
+        print_header([settings,
+                      str(r['packet_size']),
+                      '{0:.1f}'.format(r['framing_us']),
+                      '{0:.1f}'.format(r['crc_us']),
+                      '{0:.1f}'.format(r['decode_us']),
+                      '{0:.1f}'.format(r['push_us']),
+                      '{0:.0f}'.format(r['packets_per_s']),
+                      '{0:.2f}'.format(r.get('latency_p99_ms', float('nan')))], pad = 16)
+
+    out = OrderedDict()
+    out['version']  = get_version()
+    out['date']     = time.strftime('%Y-%m-%d %H:%M:%S')
+    out['python']   = platform.python_version()
+    out['numpy']    = np.__version__
+    out['platform'] = platform.platform()
+    out['machine']  = platform.machine()
+    out['lsl']      = lsl
+    out['results']  = results
+
+    with open(args.output, 'w') as f:
+        json.dump(out, f, indent = 2)
+    print("")
+    print("Results written to " + args.output)
+
+    if args.compare is not None:
+        print("")
+        with open(args.compare) as f:
+            print_comparison(results, json.load(f))
+
+
+if __name__ == '__main__':
+    benchmark_cli()
@@ -0,0 +1,216 @@
+# This file is part of Faros Streamer.
+#
+# Copyright 2015
+# Andreas Henelius <andreas.henelius@ttl.fi>,
+# Finnish Institute of Occupational Health
+#
+# This code is released under the MIT License
+# http://opensource.org/licenses/mit-license.php
+#
+# Please see the file LICENSE for details.
+
+from .libfaros import *
+from .device import decode_time
+from .recording import get_clock_path
+from pylsl import local_clock
+from concurrent.futures import ThreadPoolExecutor
+import json
+import math
+
+# -------------------------------------------------------------------------------
+# Measuring the offset and drift of the device clock
+#
+# The device clock counts whole seconds, so one wbagdt round trip,
+# sent at host time t1 and answered with device time d at t4, only
+# tells that the offset (device time - host time) is in the interval
+#
+#   [d - t4, d + 1 - t1]
+#
+# The intersection of these intervals over many round trips narrows
+# down the offset. The round trips are timed so that the device clock
+# is read close to the moment its second changes (as predicted by the
+# current interval), where each answer tells the most, and the round
+# trips that took much longer than the fastest one are left out
+# (min-RTT filtering, as in NTP). With a stable link the offset is
+# found within a few seconds to about the round-trip time.
+#
+# The device cannot be asked for its time while it is streaming, so
+# the drift is estimated from calibrations made before and after
+# streaming.
+# -------------------------------------------------------------------------------
+
+# Time used for one calibration, in seconds
+CALIBRATION_TIME = 3.0
+
+# Round trips longer than the shortest one by this much (in seconds,
+# the scheduling jitter of the host) are always used
+RTT_MARGIN = 0.002
+
+
+def measure_device_time(s):
+    """ Ask the device time once. Returns the host time (UNIX time)
+        when the request was sent and when the answer arrived, and the
+        device time.
+    """
+    device = get_device(s)
+    t1     = time.time()
+    data   = device.command('wbagdt')
+    t4     = time.time()
+    return t1, t4, decode_time(data)
+
+
+def get_offset_interval(samples):
+    """ Return the interval (lo, hi) of offsets consistent with all
+        samples (t1, t4, device time), and the number of times the
+        samples contradicted the earlier ones, e.g., because the device
+        clock was set. Only the samples after the last contradiction
+        are used.
+    """
+    lo, hi, resets = -math.inf, math.inf, 0
+    for t1, t4, d in samples:
+        lo1 = max(lo, d - t4)
+        hi1 = min(hi, d + 1.0 - t1)
+        if lo1 > hi1:
+            lo1, hi1 = d - t4, d + 1.0 - t1
+            resets  += 1
+        lo, hi = lo1, hi1
+    return lo, hi, resets
+
+
+def calibrate_clock(s, duration = CALIBRATION_TIME, burst = 8, max_samples = 200, rtt_factor = 2.0):
+    """ Measure the offset of the device clock of a device connected to
+        s (which must not be streaming) for duration seconds.
+
+        Every second a burst of requests is timed so that the device
+        clock is read at the moment its second changes if the offset
+        were at one of burst points spread over the current interval.
+        Samples with a round-trip time more than rtt_factor times the
+        shortest one (plus RTT_MARGIN) are ignored in the final
+        estimate.
+
+        Returns an OrderedDict with the host time (UNIX time) and LSL
+        time of the calibration, the offset of the device clock from
+        the host clock and from the LSL clock, the uncertainty of the
+        offset (half the width of the interval), the shortest and the
+        median round-trip time, and the number of samples (all and
+        used). All times are in seconds.
+    """
+    samples = [measure_device_time(s)]
+    t_end   = samples[0][0] + duration
+
+    while (time.time() < t_end) and (len(samples) < max_samples):
+        lo, hi, resets = get_offset_interval(samples)
+        rtt            = min(t4 - t1 for t1, t4, d in samples)
+        if hi - lo < 0.001:
+            break
+
+        # the host times at which the second of the device changes for
+        # offsets spread over the interval, in increasing order
+        n_second = math.ceil(time.time() + hi + rtt / 2.0)
+        offsets  = [hi - (hi - lo) * (i + 0.5) / burst for i in range(burst)]
+        n        = len(samples)
+        for offset in offsets:
+            t_send = n_second - offset - rtt / 2.0
+            if t_send > t_end:
+                break
+            delay  = t_send - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            samples.append(measure_device_time(s))
+
+        if len(samples) == n:
+            # the next change of the second is after the end
+            break
+
+    rtts    = sorted(t4 - t1 for t1, t4, d in samples)
+    used    = [x for x in samples if x[1] - x[0] <= rtt_factor * rtts[0] + RTT_MARGIN]
+    lo, hi, resets = get_offset_interval(used)
+
+    # the host clock and the LSL clock are read at the same moment
+    t_host  = time.time()
+    t_lsl   = local_clock()
+    offset  = (lo + hi) / 2.0
+
+    out = OrderedDict()
+    out['time']         = t_host
+    out['lsl_time']     = t_lsl
+    out['offset']       = offset
+    out['lsl_offset']   = offset + (t_host - t_lsl)
+    out['uncertainty']  = (hi - lo) / 2.0
+    out['min_rtt']      = rtts[0]
+    out['median_rtt']   = rtts[len(rtts) // 2]
+    out['samples']      = len(samples)
+    out['used_samples'] = len(used)
+    return(out)
+
+
+def estimate_drift(calibrations):
+    """ Return the drift of the device clock relative to the host clock
+        in parts per million, fitted to the offsets of calibrations (a
+        list of calibrate_clock results), and its uncertainty. Returns
+        (None, None) with fewer than two calibrations.
+    """
+    if len(calibrations) < 2:
+        return None, None
+
+    t  = np.array([c['time'] for c in calibrations])
+    x  = np.array([c['offset'] for c in calibrations])
+    u  = np.array([max(c['uncertainty'], 1e-4) for c in calibrations])
+    dt = t.max() - t.min()
+    if dt <= 0:
+        return None, None
+
+    slope = np.polyfit(t - t.min(), x, 1, w = 1.0 / u)[0]
+    # the worst case given the uncertainties of the first and last calibration
+    error = (u[np.argmin(t)] + u[np.argmax(t)]) / dt
+    return 1e6 * slope, 1e6 * error
+
+
+def print_clock_calibration(name, calibration):
+    print("-" * 45)
+    print("Clock calibration (" + str(name) + ")")
+    print("-" * 45)
+    print_kv("Offset (ms)", "{0:.1f} +/- {1:.1f}".format(1e3 * calibration['offset'], 1e3 * calibration['uncertainty']))
+    print_kv("Round trip (ms)", "{0:.1f} (median {1:.1f})".format(1e3 * calibration['min_rtt'], 1e3 * calibration['median_rtt']))
+    print_kv("Samples", "{0} ({1} used)".format(calibration['samples'], calibration['used_samples']))
+    print("-" * 45)
+    print("")
+
+
+def calibrate_devices(sockets, names, duration = CALIBRATION_TIME):
+    """ Calibrate the clocks of several devices at the same time and
+        print the results. Returns the calibrations, with None for the
+        devices whose calibration failed.
+    """
+    with ThreadPoolExecutor(max_workers = max(1, len(sockets))) as pool:
+        futures = [pool.submit(calibrate_clock, s, duration) for s in sockets]
+
+    out = []
+    for name, future in zip(names, futures):
+        try:
+            calibration = future.result()
+            print_clock_calibration(name, calibration)
+        except (OSError, ValueError) as e:
+            print("Clock calibration of {0} failed ({1}).".format(name, str(e) or type(e).__name__))
+            calibration = None
+        out.append(calibration)
+    return(out)
+
+
+def write_clock_file(path, properties, calibrations, packet_drift_ppm = None):
+    """ Write the calibrations of a device into the clock file of the
+        capture file path (see get_clock_path), with the estimated
+        drift. packet_drift_ppm is the drift of the packet clock
+        relative to the LSL clock measured while streaming.
+    """
+    drift, drift_error = estimate_drift(calibrations)
+
+    out = OrderedDict()
+    out['name']                  = properties.get('name')
+    out['calibrations']          = calibrations
+    out['drift_ppm']             = drift
+    out['drift_uncertainty_ppm'] = drift_error
+    out['packet_drift_ppm']      = packet_drift_ppm
+
+    with open(get_clock_path(path), 'w') as f:
+        json.dump(out, f, indent = 2)
@@ -0,0 +1,95 @@
+# This file is part of Faros Streamer.
+#
+# Copyright 2015
+# Andreas Henelius <andreas.henelius@ttl.fi>,
+# Finnish Institute of Occupational Health
+#
+# This code is released under the MIT License
+# http://opensource.org/licenses/mit-license.php
+#
+# Please see the file LICENSE for details.
+
+import numpy as np
+
+# -------------------------------------------------------------------------------
+# CRC-16/XMODEM checksums of Faros packets
+#
+# The last two bytes of a packet are the CRC-16/XMODEM (polynomial
+# 0x1021, initial value 0) of the rest of the packet, stored as an
+# unsigned little-endian integer.
+#
+# The crc16 C extension is used for single packets if it is installed
+# and works, otherwise a table-driven implementation is used.
+# -------------------------------------------------------------------------------
+
+def get_crc_table(poly = 0x1021):
+    """ Return the CRC-16 lookup table (256 uint16 values) for poly. """
+    table = np.zeros(256, dtype = np.uint16)
+    for i in range(256):
+        crc = i << 8
+        for j in range(8):
+            if crc & 0x8000:
+                crc = ((crc << 1) ^ poly) & 0xFFFF
+            else:
+                crc = (crc << 1) & 0xFFFF
+        table[i] = crc
+    return(table)
+
+
+CRC_TABLE      = get_crc_table()
+CRC_TABLE_LIST = [int(x) for x in CRC_TABLE]
+
+try:
+    import crc16 as _crc16
+    # the extension fails with a SystemError on newer Pythons
+    _crc16.crc16xmodem(b'123456789')
+except (ImportError, SystemError):
+    _crc16 = None
+
+
+def crc16xmodem_table(data, crc = 0):
+    """ Table-driven CRC-16/XMODEM of data (bytes-like). """
+    table = CRC_TABLE_LIST
+    for b in bytes(data):
+        crc = ((crc << 8) & 0xFFFF) ^ table[(crc >> 8) ^ b]
+    return crc
+
+
+def crc16xmodem(data, crc = 0):
+    """ CRC-16/XMODEM of data (bytes-like), as an unsigned integer. """
+    if _crc16 is not None:
+        return _crc16.crc16xmodem(bytes(data), crc)
+    return crc16xmodem_table(data, crc)
+
+
+def crc16xmodem_frames(frames):
+    """ CRC-16/XMODEM of each row of frames (2D uint8 array) in one
+        pass over the columns. Returns a uint16 array.
+    """
+    frames = np.asarray(frames, dtype = np.uint8)
+    crc    = np.zeros(frames.shape[0], dtype = np.uint16)
+    for j in range(frames.shape[1]):
+        crc = (crc << 8) ^ CRC_TABLE[(crc >> 8) ^ frames[:, j]]
+    return crc
+
+
+def get_packet_crc(packet):
+    """ The checksum stored in the last two bytes of a packet. """
+    return packet[-2] | (packet[-1] << 8)
+
+
+def check_packet(packet):
+    """ Check the signature and checksum of one packet (bytes-like). """
+    return (packet[0:3] == b'MEP') and (crc16xmodem(packet[:-2]) == get_packet_crc(packet))
+
+
+def check_frames(frames):
+    """ Check the signatures and checksums of a number of packets of
+        the same size, given as a 2D uint8 array with one packet on
+        each row. Returns a boolean array.
+    """
+    frames = np.asarray(frames, dtype = np.uint8)
+    valid  = (frames[:, 0] == ord('M')) & (frames[:, 1] == ord('E')) & (frames[:, 2] == ord('P'))
+    stored = frames[:, -2].astype(np.uint16) | (frames[:, -1].astype(np.uint16) << 8)
+    valid &= crc16xmodem_frames(frames[:, 0:-2]) == stored
+    return valid
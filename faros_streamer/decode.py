@@ -0,0 +1,202 @@
+# This file is part of Faros Streamer.
+#
+# Copyright 2015
+# Andreas Henelius <andreas.henelius@ttl.fi>,
+# Finnish Institute of Occupational Health
+#
+# This code is released under the MIT License
+# http://opensource.org/licenses/mit-license.php
+#
+# Please see the file LICENSE for details.
+
+from .libfaros import *
+from .recording import CaptureReader
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import os
+
+# -------------------------------------------------------------------------------
+# Decoding capture files into arrays
+# -------------------------------------------------------------------------------
+
+def check_packets(path, i1, i2):
+    """ Check the signatures and checksums of packets i1, ..., i2 - 1
+        of a capture file. Returns a boolean array.
+    """
+    reader = CaptureReader(path)
+    ps     = reader.layout.size
+    raw    = np.frombuffer(reader.mm, dtype = np.uint8, count = (i2 - i1) * ps,
+                           offset = reader.data_offset + i1 * ps).reshape((i2 - i1, ps))
+
+    valid  = check_frames(raw)
+
+    del raw
+    reader.close()
+    return valid
+
+
+def get_outputs(layout, n_packets):
+    """ Return the names, shapes and types of the arrays decoded from
+        n_packets packets with the given PacketLayout.
+    """
+    out = OrderedDict()
+    out['packet_number'] = ((n_packets,), np.uint32)
+    out['arrival_time']  = ((n_packets,), np.float64)
+    out['flag']          = ((n_packets,), np.uint8)
+    if layout.n_ecg_s > 0:
+        out['ecg']       = ((n_packets * layout.n_ecg_s, layout.n_ecg_c), np.int16)
+    if layout.n_acc_s > 0:
+        out['acc']       = ((n_packets * layout.n_acc_s, 3), np.int16)
+    out['marker']        = ((n_packets,), np.int16)
+    if layout.n_rr_s > 0:
+        out['rr']        = ((n_packets,), np.int16)
+    if layout.n_temp_s > 0:
+        out['temp']      = ((n_packets,), np.float32)
+    return(out)
+
+
+def decode_into(reader, index, arrays, offset):
+    """ Decode the packets of a capture file selected by index (an array
+        of positions) into arrays (see get_outputs), starting at
+        packet offset.
+    """
+    layout  = reader.layout
+    packets = reader.packets[index]
+    n       = len(packets)
+    b1      = offset
+    b2      = offset + n
+
+    arrays['packet_number'][b1:b2] = packets['packet_number']
+    arrays['arrival_time'][b1:b2]  = reader.index['arrival_time'][index]
+    arrays['flag'][b1:b2]          = packets['flag']
+    arrays['marker'][b1:b2]        = packets['marker']
+
+    # (packets, channels, samples) -> (packets * samples, channels)
+    if 'ecg' in arrays:
+        s = layout.n_ecg_s
+        arrays['ecg'][(b1 * s):(b2 * s)] = packets['ecg'].transpose(0, 2, 1).reshape((n * s, layout.n_ecg_c))
+
+    if 'acc' in arrays:
+        s = layout.n_acc_s
+        arrays['acc'][(b1 * s):(b2 * s)] = packets['acc'].transpose(0, 2, 1).reshape((n * s, 3))
+
+    if 'rr' in arrays:
+        arrays['rr'][b1:b2] = packets['rr']
+
+    if 'temp' in arrays:
+        # convert raw ADC values to degrees Celsius
+        arrays['temp'][b1:b2] = packets['temp'] * (-(158.3488 + 53.3361)/4095) + 158.3488
+
+
+def decode_npy_chunk(path, out_dir, index, offset):
+    """ Decode the packets selected by index into the .npy files in
+        out_dir (which must already exist), starting at packet offset.
+    """
+    reader = CaptureReader(path)
+    arrays = {}
+    for name in get_outputs(reader.layout, 0):
+        arrays[name] = np.load(os.path.join(out_dir, name + '.npy'), mmap_mode = 'r+')
+
+    decode_into(reader, index, arrays, offset)
+
+    for name in arrays:
+        arrays[name].flush()
+    del arrays
+    reader.close()
+
+
+def split_range(n, n_chunks):
+    """ Split range(n) into at most n_chunks consecutive (start, end) pairs. """
+    bounds = np.linspace(0, n, max(1, n_chunks) + 1).astype(int)
+    return [(int(bounds[i]), int(bounds[i + 1])) for i in range(len(bounds) - 1) if bounds[i + 1] > bounds[i]]
+
+
+def decode_capture(path, output, jobs = None, chunk_packets = 50000):
+    """ Decode a capture file into one .npy file for each modality in
+        the directory output, or into an HDF5 file if output ends with
+        .h5 or .hdf5 (requires h5py). Packets with a bad signature or
+        checksum are left out. The work is split into chunks of
+        chunk_packets packets, which are processed by jobs processes.
+        Returns the number of decoded and bad packets.
+    """
+    reader    = CaptureReader(path)
+    layout    = reader.layout
+    n_packets = len(reader)
+    reader.close()
+
+    chunks = split_range(n_packets, (n_packets + chunk_packets - 1) // chunk_packets)
+
+    with ProcessPoolExecutor(max_workers = jobs) as pool:
+        # (1) Check all packets
+        futures = [pool.submit(check_packets, path, i1, i2) for i1, i2 in chunks]
+        valid   = [f.result() for f in futures]
+        index   = [i1 + np.flatnonzero(v) for (i1, i2), v in zip(chunks, valid)]
+        n_valid = sum(len(i) for i in index)
+        outputs = get_outputs(layout, n_valid)
+
+        # (2) Decode the packets
+        if output.endswith('.h5') or output.endswith('.hdf5'):
+            try:
+                import h5py
+            except ImportError:
+                raise RuntimeError("Writing HDF5 files requires h5py (pip install h5py)")
+
+            # HDF5 files cannot be written from several processes, so
+            # the chunks are decoded here one at a time
+            reader = CaptureReader(path)
+            with h5py.File(output, 'w') as f:
+                for k in reader.header:
+                    f.attrs[k] = str(reader.header[k])
+                arrays = {}
+                for name in outputs:
+                    shape, dtype = outputs[name]
+                    chunks_h5    = (min(shape[0], 65536),) + shape[1:] if shape[0] > 0 else None
+                    arrays[name] = f.create_dataset(name, shape = shape, dtype = dtype, chunks = chunks_h5)
+
+                offset = 0
+                for i in index:
+                    if len(i) == 0:
+                        continue
+                    part = OrderedDict()
+                    for name, (shape, dtype) in get_outputs(layout, len(i)).items():
+                        part[name] = np.zeros(shape, dtype = dtype)
+                    decode_into(reader, i, part, 0)
+                    for name in part:
+                        rows = len(part[name]) // len(i)
+                        arrays[name][(offset * rows):((offset + len(i)) * rows)] = part[name]
+                    offset += len(i)
+            reader.close()
+        else:
+            if not os.path.exists(output):
+                os.makedirs(output)
+            for name in outputs:
+                shape, dtype = outputs[name]
+                a = np.lib.format.open_memmap(os.path.join(output, name + '.npy'), mode = 'w+', dtype = dtype, shape = shape)
+                del a
+
+            offsets = np.cumsum([0] + [len(i) for i in index])
+            futures = [pool.submit(decode_npy_chunk, path, output, i, int(o)) for i, o in zip(index, offsets) if len(i) > 0]
+            for f in futures:
+                f.result()
+
+    return n_valid, n_packets - n_valid
+
+
+def decode_cli():
+    parser = argparse.ArgumentParser(description = "Decode a Faros capture file (see faros --record) into NumPy or HDF5 arrays.")
+    parser.add_argument("capture", help="The capture file.")
+    parser.add_argument("output", help="Output directory for .npy files, or an HDF5 file (.h5 or .hdf5).")
+    parser.add_argument("--jobs", dest = "jobs", type = int, help="Number of processes. Default is the number of CPUs.", default = None)
+    parser.add_argument("--chunk-packets", dest = "chunk_packets", type = int, help="Number of packets decoded by a process at a time. Default is 50000.", default = 50000)
+
+    args = parser.parse_args()
+
+    t0 = time.time()
+    n_valid, n_bad = decode_capture(args.capture, args.output, args.jobs, args.chunk_packets)
+    print_kv("Packets decoded", n_valid)
+    print_kv("Bad packets", n_bad)
+    print_kv("Time (s)", round(time.time() - t0, 2))
+
+
+if __name__ == '__main__':
+    decode_cli()
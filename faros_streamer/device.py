@@ -0,0 +1,366 @@
+# This file is part of Faros Streamer.
+#
+# Copyright 2015
+# Andreas Henelius <andreas.henelius@ttl.fi>,
+# Finnish Institute of Occupational Health
+#
+# This code is released under the MIT License
+# http://opensource.org/licenses/mit-license.php
+#
+# Please see the file LICENSE for details.
+
+import asyncio
+import socket
+import struct
+import threading
+import time
+import weakref
+
+# -------------------------------------------------------------------------------
+# The command protocol of Faros devices
+#
+# A command is six ASCII characters, an optional argument and '\r'.
+# Most commands are answered with a fixed number of bytes ending in
+# '\r', e.g., 'wbaack\r'. The answer to wbawho is two bytes longer for
+# devices whose name starts with FAROS. wbaled is not answered.
+# -------------------------------------------------------------------------------
+
+# Response length of each command
+RESPONSE_LENGTH = {'wbaoms' : 7,   # offline mode (stop streaming)
+                   'wbaom7' : 7,   # online mode (start streaming)
+                   'wbaled' : 0,   # blink the LEDs
+                   'wbagds' : 12,  # get settings
+                   'wbasds' : 7,   # set settings
+                   'wbagdt' : 8,   # get device time
+                   'wbasdt' : 7,   # set device time
+                   'wbawho' : 12,  # get name
+                   'wbainf' : 9,   # get firmware version
+                   'wbaind' : 9}   # get firmware build date
+
+ACK = b'wbaack'
+
+# Default time to wait for a response, in seconds
+COMMAND_TIMEOUT = 5.0
+
+
+def encode_command(command, argument = b''):
+    """ Return the bytes sent to the device for a command. """
+    return command.encode('ascii') + argument + b'\r'
+
+
+def decode_response(data):
+    """ Decode a response of a Faros device to ASCII. """
+    try:
+        return data.decode("UTF-8").strip()
+    except UnicodeDecodeError:
+        return None
+
+
+def encode_time(t = None):
+    """ Return the argument of wbasdt for setting the device time to
+        UNIX time t (default: now). The device keeps local time.
+    """
+    if t is None:
+        t = time.time()
+    return struct.pack('<i', int(t) - time.timezone)
+
+
+def decode_time(data):
+    """ Return the device time in a wbagdt response as UNIX time. """
+    return float(struct.unpack('<L', data[3:7])[0]) + time.timezone
+
+
+def recv_exact(s, n):
+    """ Read exactly n bytes from socket s. Fewer bytes are returned
+        only if the connection is closed.
+    """
+    data = b''
+    while len(data) < n:
+        chunk = s.recv(n - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return(data)
+
+
+class FarosDevice(object):
+    """ Blocking interface to a Faros device connected to socket s.
+
+        Each command and its response are sent and read while holding
+        a lock, so the device can be used from several threads. If no
+        complete response arrives within timeout seconds,
+        socket.timeout is raised; None waits forever. The timeout of
+        the socket is restored after each command.
+    """
+    def __init__(self, s, timeout = COMMAND_TIMEOUT):
+        self.socket  = s
+        self.timeout = timeout
+        self.lock    = threading.RLock()
+
+    @classmethod
+    def connect(cls, addr, port = 1, timeout = COMMAND_TIMEOUT):
+        """ Connect to the device with bluetooth address addr. """
+        import bluetooth
+        s = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
+        s.connect((addr, port))
+        return cls(s, timeout)
+
+    def close(self):
+        self.socket.close()
+
+    def commands(self, commands):
+        """ Send several commands at once and read their responses in
+            order. commands is a list of (command, response length,
+            argument); the response length None means the length in
+            RESPONSE_LENGTH. Returns the responses as bytes.
+        """
+        lengths = [RESPONSE_LENGTH[c] if n is None else n for c, n, a in commands]
+        request = b''.join(encode_command(c, a) for c, n, a in commands)
+
+        with self.lock:
+            s = self.socket
+            if not any(lengths):
+                # the socket may be read by a streaming thread, so its
+                # timeout is left alone
+                s.sendall(request)
+                return [b''] * len(commands)
+
+            old = s.gettimeout()
+            s.settimeout(self.timeout)
+            try:
+                s.sendall(request)
+                out = []
+                for (command, n, argument), r_length in zip(commands, lengths):
+                    data = recv_exact(s, r_length)
+                    if len(data) < r_length:
+                        raise ConnectionError("connection closed while waiting for a response to " + command)
+                    out.append(data)
+            finally:
+                s.settimeout(old)
+        return(out)
+
+    def command(self, command, r_length = None, argument = b''):
+        """ Send a command and return its response (bytes). """
+        return self.commands([(command, r_length, argument)])[0]
+
+    def stop_streaming(self):
+        return self.command('wbaoms').strip() == ACK
+
+    def start_streaming(self):
+        return self.command('wbaom7').strip() == ACK
+
+    def blink(self):
+        self.command('wbaled')
+
+    def get_settings(self):
+        """ Return the settings, e.g., 'wba11101101' (see unpack_settings). """
+        return decode_response(self.command('wbagds'))
+
+    def set_settings(self, settings):
+        """ Store the 8-character settings (see mode_to_str). """
+        return self.command('wbasds', argument = settings.encode('ascii')).strip() == ACK
+
+    def get_time(self):
+        """ Return the device time as UNIX time. """
+        return decode_time(self.command('wbagdt'))
+
+    def set_time(self, t = None):
+        """ Set the device time to UNIX time t (default: now). """
+        return self.command('wbasdt', argument = encode_time(t)).strip() == ACK
+
+    def get_name(self):
+        with self.lock:
+            name = decode_response(self.command('wbawho'))
+            if (name is not None) and name.startswith('FAROS'):
+                name += decode_response(self.read_exact(2))
+        return name
+
+    def get_firmware_version(self):
+        return decode_response(self.command('wbainf'))
+
+    def get_firmware_build(self):
+        return decode_response(self.command('wbaind'))
+
+    def get_properties(self):
+        """ Return the name, firmware version and build, device time
+            (the raw wbagdt response) and settings, asking for all of
+            them at once. The name is asked last, as its length depends
+            on the device.
+        """
+        with self.lock:
+            res = self.commands([('wbainf', None, b''),
+                                 ('wbaind', None, b''),
+                                 ('wbagdt', None, b''),
+                                 ('wbagds', None, b''),
+                                 ('wbawho', None, b'')])
+            out = {'firmware-version' : decode_response(res[0]),
+                   'firmware-build'   : decode_response(res[1]),
+                   'device_time'      : res[2],
+                   'settings'         : decode_response(res[3]),
+                   'name'             : decode_response(res[4])}
+            if (out['name'] is not None) and out['name'].startswith('FAROS'):
+                out['name'] += decode_response(self.read_exact(2))
+        return(out)
+
+    def flush(self, quiet = 0.5):
+        """ Read and discard the data sent by the device until nothing
+            arrives for quiet seconds, e.g., the rest of the stream after
+            stopping streaming. Returns the number of bytes discarded.
+        """
+        with self.lock:
+            s   = self.socket
+            old = s.gettimeout()
+            s.settimeout(quiet)
+            n   = 0
+            try:
+                while True:
+                    data = s.recv(4096)
+                    if not data:
+                        break
+                    n += len(data)
+            except socket.timeout:
+                pass
+            finally:
+                s.settimeout(old)
+        return n
+
+    def read_exact(self, n):
+        """ Read exactly n bytes, waiting at most timeout seconds. """
+        with self.lock:
+            s   = self.socket
+            old = s.gettimeout()
+            s.settimeout(self.timeout)
+            try:
+                data = recv_exact(s, n)
+            finally:
+                s.settimeout(old)
+        if len(data) < n:
+            raise ConnectionError("connection closed")
+        return data
+
+
+# FarosDevice objects of the sockets used with the functions in libfaros
+_devices = weakref.WeakKeyDictionary()
+
+
+def get_device(s):
+    """ Return the FarosDevice of socket s, so that all commands sent
+        to a socket share one lock.
+    """
+    if isinstance(s, FarosDevice):
+        return s
+    try:
+        device = _devices.get(s)
+        if device is None:
+            device = _devices[s] = FarosDevice(s)
+    except TypeError:
+        # the socket cannot be weakly referenced
+        device = FarosDevice(s)
+    return device
+
+
+class AsyncFarosDevice(object):
+    """ asyncio interface to a Faros device, with the same methods as
+        FarosDevice as coroutines. Many devices can be driven from one
+        event loop.
+
+        reader and writer are the asyncio streams of the connection
+        (see open and connect).
+    """
+    def __init__(self, reader, writer, timeout = COMMAND_TIMEOUT):
+        self.reader  = reader
+        self.writer  = writer
+        self.timeout = timeout
+        self.lock    = asyncio.Lock()
+
+    @classmethod
+    async def open(cls, s, timeout = COMMAND_TIMEOUT):
+        """ Use the connected socket s. """
+        reader, writer = await asyncio.open_connection(sock = s)
+        return cls(reader, writer, timeout)
+
+    @classmethod
+    async def connect(cls, addr, port = 1, timeout = COMMAND_TIMEOUT):
+        """ Connect to the device with bluetooth address addr (Linux). """
+        s = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_STREAM, socket.BTPROTO_RFCOMM)
+        s.setblocking(False)
+        await asyncio.wait_for(asyncio.get_running_loop().sock_connect(s, (addr, port)), timeout)
+        return await cls.open(s, timeout)
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+
+    async def read_exact(self, n):
+        return await asyncio.wait_for(self.reader.readexactly(n), self.timeout)
+
+    async def read(self, n):
+        """ Read at most n bytes of streamed data. b'' means the
+            connection was closed.
+        """
+        return await self.reader.read(n)
+
+    async def commands(self, commands):
+        """ See FarosDevice.commands. """
+        async with self.lock:
+            self.writer.write(b''.join(encode_command(c, a) for c, n, a in commands))
+            await asyncio.wait_for(self.writer.drain(), self.timeout)
+            out = []
+            for command, r_length, argument in commands:
+                if r_length is None:
+                    r_length = RESPONSE_LENGTH[command]
+                out.append(await self.read_exact(r_length) if r_length else b'')
+        return(out)
+
+    async def command(self, command, r_length = None, argument = b''):
+        return (await self.commands([(command, r_length, argument)]))[0]
+
+    async def stop_streaming(self):
+        return (await self.command('wbaoms')).strip() == ACK
+
+    async def start_streaming(self):
+        return (await self.command('wbaom7')).strip() == ACK
+
+    async def blink(self):
+        await self.command('wbaled')
+
+    async def get_settings(self):
+        return decode_response(await self.command('wbagds'))
+
+    async def set_settings(self, settings):
+        return (await self.command('wbasds', argument = settings.encode('ascii'))).strip() == ACK
+
+    async def get_time(self):
+        return decode_time(await self.command('wbagdt'))
+
+    async def set_time(self, t = None):
+        return (await self.command('wbasdt', argument = encode_time(t))).strip() == ACK
+
+    async def get_name(self):
+        async with self.lock:
+            self.writer.write(encode_command('wbawho'))
+            await asyncio.wait_for(self.writer.drain(), self.timeout)
+            name = decode_response(await self.read_exact(RESPONSE_LENGTH['wbawho']))
+            if (name is not None) and name.startswith('FAROS'):
+                name += decode_response(await self.read_exact(2))
+        return name
+
+    async def get_firmware_version(self):
+        return decode_response(await self.command('wbainf'))
+
+    async def get_firmware_build(self):
+        return decode_response(await self.command('wbaind'))
+
+    async def get_properties(self):
+        """ See FarosDevice.get_properties. """
+        out = {}
+        res = await self.commands([('wbainf', None, b''),
+                                   ('wbaind', None, b''),
+                                   ('wbagdt', None, b''),
+                                   ('wbagds', None, b'')])
+        out['firmware-version'] = decode_response(res[0])
+        out['firmware-build']   = decode_response(res[1])
+        out['device_time']      = res[2]
+        out['settings']         = decode_response(res[3])
+        out['name']             = await self.get_name()
+        return(out)
@@ -0,0 +1,153 @@
+# This file is part of Faros Streamer.
+#
+# Copyright 2015
+# Andreas Henelius <andreas.henelius@ttl.fi>,
+# Finnish Institute of Occupational Health
+#
+# This code is released under the MIT License
+# http://opensource.org/licenses/mit-license.php
+#
+# Please see the file LICENSE for details.
+
+import json
+import os
+import threading
+import time
+
+# -------------------------------------------------------------------------------
+# Cache of the devices found by scanning
+#
+# The cache is a JSON file of the form
+#
+#   {"version": 1,
+#    "devices": {"AA:BB:CC:11:22:33": {"name": "FAROS-1234", "seen": 1420070400.0,
+#                                      "properties": {...}}}}
+#
+# where seen is the time (seconds since the epoch) the device was last
+# found and properties are the CACHED_PROPERTIES of the device, stored
+# when connecting to it. Entries older than the time-to-live are ignored.
+# -------------------------------------------------------------------------------
+
+CACHE_VERSION = 1
+
+# One week
+CACHE_TTL = 7 * 24 * 3600
+
+# The device properties (see get_properties) stored in the cache
+CACHED_PROPERTIES = ['name', 'firmware-version', 'firmware-build', 'settings']
+
+
+def get_cache_path():
+    """ Return the default path of the device cache. """
+    root = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(root, 'faros-streamer', 'devices.json')
+
+
+class DeviceCache(object):
+    """ Persistent cache of device names and bluetooth addresses.
+
+        The entries are indexed both by address (by_mac) and by name
+        (by_name). Changes are written to disk by save. The cache can
+        be updated from several threads.
+    """
+    def __init__(self, path = None, ttl = CACHE_TTL):
+        self.path    = path if path is not None else get_cache_path()
+        self.ttl     = ttl
+        self.lock    = threading.RLock()
+        self.by_mac  = {}
+        self.by_name = {}
+        self.load()
+
+    def load(self):
+        """ Read the cache file. A missing or unreadable file gives an
+            empty cache.
+        """
+        self.by_mac  = {}
+        self.by_name = {}
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            if data.get('version') == CACHE_VERSION:
+                for mac, entry in data['devices'].items():
+                    self.add(mac, entry)
+        except (IOError, OSError, ValueError, KeyError, AttributeError):
+            pass
+
+    def save(self):
+        """ Write the cache file (atomically). """
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        with self.lock:
+            data = {'version' : CACHE_VERSION,
+                    'devices' : self.by_mac}
+            tmp  = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(data, f, indent = 2, sort_keys = True)
+            os.replace(tmp, self.path)
+
+    def add(self, mac, entry):
+        mac = mac.upper()
+        old = self.by_mac.get(mac)
+        if (old is not None) and (self.by_name.get(old['name']) == mac):
+            del self.by_name[old['name']]
+        self.by_mac[mac]            = entry
+        self.by_name[entry['name']] = mac
+
+    def is_fresh(self, entry):
+        return (self.ttl is None) or (time.time() - entry.get('seen', 0) <= self.ttl)
+
+    def update(self, devices):
+        """ Add the devices found by a scan (a dictionary of names and
+            addresses, see get_devices) and save the cache.
+        """
+        now = time.time()
+        with self.lock:
+            for name, mac in devices.items():
+                entry         = dict(self.by_mac.get(mac.upper(), {}))
+                entry['name'] = name
+                entry['seen'] = now
+                self.add(mac, entry)
+            self.save()
+
+    def get_mac(self, name):
+        """ Return the address of the device called name, or None. """
+        mac = self.by_name.get(name)
+        if (mac is None) or not self.is_fresh(self.by_mac[mac]):
+            return None
+        return mac
+
+    def get_name(self, mac):
+        """ Return the name of the device with address mac, or None. """
+        entry = self.by_mac.get(mac.upper())
+        if (entry is None) or not self.is_fresh(entry):
+            return None
+        return entry['name']
+
+    def get_properties(self, mac):
+        """ Return the cached properties (name, firmware version and
+            build, settings) of the device with address mac, or None.
+        """
+        entry = self.by_mac.get(mac.upper())
+        if (entry is None) or not self.is_fresh(entry):
+            return None
+        return entry.get('properties')
+
+    def set_properties(self, mac, properties):
+        """ Store the properties (see get_properties) of the device
+            with address mac and save the cache.
+        """
+        with self.lock:
+            entry               = dict(self.by_mac.get(mac.upper(), {}))
+            entry['name']       = properties['name']
+            entry['seen']       = time.time()
+            entry['properties'] = {k : properties[k] for k in CACHED_PROPERTIES}
+            self.add(mac, entry)
+            self.save()
+
+    def get_devices(self):
+        """ Return a dictionary with the names and addresses of the
+            devices in the cache that have not expired.
+        """
+        return {entry['name'] : mac for mac, entry in self.by_mac.items() if self.is_fresh(entry)}
@@ -0,0 +1,245 @@
+# This file is part of Faros Streamer.
+#
+# Copyright 2015
+# Andreas Henelius <andreas.henelius@ttl.fi>,
+# Finnish Institute of Occupational Health
+#
+# This code is released under the MIT License
+# http://opensource.org/licenses/mit-license.php
+#
+# Please see the file LICENSE for details.
+
+from .libfaros import *
+from .utilities import *
+from .devices import DeviceCache, CACHE_TTL
+from .transport import is_mac_address
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import csv
+
+# -------------------------------------------------------------------------------
+# Preparing many devices at once
+#
+# A manifest is a CSV file with one device per row. The column device
+# holds the bluetooth address, the name or the transport URI (see
+# open_transport) of the device. The settings are given either as an
+# 8-character string in the column settings (see mode_to_str) or in
+# the columns MANIFEST_SETTINGS, e.g.,
+#
+#   device,ecg_n,ecg_fs,acc_fs,rr,temp
+#   AATOS-0001,1,250,25,1,0
+#   AA:BB:CC:11:22:33,3,500,100,0,1
+#
+# Missing or empty columns get the defaults of faros --configure
+# (MANIFEST_DEFAULTS). Devices without settings are not configured.
+# Empty lines and lines starting with # are ignored.
+# -------------------------------------------------------------------------------
+
+MANIFEST_SETTINGS = ['ecg_n', 'ecg_fs', 'ecg_res', 'ecg_hp', 'rr', 'acc_fs', 'acc_res', 'temp']
+
+MANIFEST_DEFAULTS = {'ecg_n'   : '1',
+                     'ecg_fs'  : '250',
+                     'ecg_res' : '1',
+                     'ecg_hp'  : '0.05',
+                     'rr'      : '0',
+                     'acc_fs'  : '25',
+                     'acc_res' : '1',
+                     'temp'    : '0'}
+
+
+def is_uri(x):
+    """ Is x a transport URI (see open_transport). """
+    return '://' in x
+
+
+def read_manifest(path):
+    """ Read a manifest. Returns a list of dictionaries with the
+        device (address or name) and settings (string or None).
+    """
+    with open(path) as f:
+        lines = [line for line in f if line.strip() and not line.lstrip().startswith('#')]
+
+    out = []
+    for i, row in enumerate(csv.DictReader(lines)):
+        row    = {k.strip() : (v or '').strip() for k, v in row.items() if k is not None}
+        device = row.get('device', '')
+        if device == '':
+            raise ValueError("No device on row {0} of {1}".format(i + 1, path))
+
+        if row.get('settings'):
+            settings = row['settings']
+        elif any(row.get(k) for k in MANIFEST_SETTINGS):
+            settings = {k : row.get(k) or MANIFEST_DEFAULTS[k] for k in MANIFEST_SETTINGS}
+        else:
+            settings = None
+
+        if settings is not None:
+            try:
+                if isinstance(settings, dict):
+                    settings = mode_to_str(**settings)
+                unpack_settings('wba' + settings)
+            except (KeyError, IndexError, ValueError):
+                if isinstance(settings, dict):
+                    settings = ', '.join('{0}={1}'.format(k, settings[k]) for k in MANIFEST_SETTINGS)
+                raise ValueError("Invalid settings for {0}: {1}".format(device, settings))
+
+        out.append({'device' : device, 'settings' : settings})
+    return(out)
+
+
+def prepare_device(device, device_mac, settings = None, sync = True, cache = None, time_tolerance = 2.0):
+    """ Connect to a device, configure it (if settings are given),
+        set its time (if sync is True) and read back its properties to
+        check the result. Returns an OrderedDict with the outcome and
+        the time taken by each step in seconds.
+    """
+    out = OrderedDict()
+    out['device']      = device
+    out['mac']         = device_mac
+    out['name']        = None
+    out['status']      = 'ok'
+    out['settings']    = settings
+    out['connect']     = None
+    out['configure']   = None
+    out['sync']        = None
+    out['verify']      = None
+    out['time_offset'] = None
+    out['error']       = ''
+
+    if device_mac is None:
+        out['status'] = 'failed'
+        out['error']  = 'device not found'
+        return(out)
+
+    try:
+        t0 = time.perf_counter()
+        s, properties  = open_device(device_mac, cache)
+        out['connect'] = time.perf_counter() - t0
+        out['name']    = properties['name']
+
+        try:
+            if (settings is not None) and (properties['settings'] != 'wba' + settings):
+                t0 = time.perf_counter()
+                ok = configure_device(s, settings, verbose = False)
+                out['configure'] = time.perf_counter() - t0
+                if not ok:
+                    raise RuntimeError("settings not stored")
+
+            if sync:
+                t0  = time.perf_counter()
+                res = set_device_time(s)
+                out['sync'] = time.perf_counter() - t0
+                if res.strip() != b'wbaack':
+                    raise RuntimeError("time not set")
+
+            t0 = time.perf_counter()
+            properties    = get_properties(s)
+            out['verify'] = time.perf_counter() - t0
+            if (cache is not None) and (get_transport_mac(device_mac) is not None):
+                cache.set_properties(get_transport_mac(device_mac), properties)
+
+            out['time_offset'] = binary_time_to_unix_time(properties['device_time']) - (time.time() - time.timezone)
+
+            if (settings is not None) and (properties['settings'] != 'wba' + settings):
+                raise RuntimeError("device has settings " + str(properties['settings']))
+            if sync and (abs(out['time_offset']) > time_tolerance):
+                raise RuntimeError("device time is off by {0:.0f} s".format(out['time_offset']))
+        finally:
+            disconnect(s)
+
+    except Exception as e:
+        out['status'] = 'failed'
+        out['error']  = str(e) or type(e).__name__
+
+    return(out)
+
+
+def resolve_devices(devices, device_list, cache, lookup_timeout = 10):
+    """ Return the bluetooth addresses of devices (addresses or names),
+        scanning for devices only if some name is not found in
+        device_list or the cache. Unknown names give None.
+    """
+    known = {}
+    if cache is not None:
+        known.update(cache.get_devices())
+    if device_list is not None:
+        known.update(device_list)
+
+    if any((not is_mac_address(d)) and (not is_uri(d)) and (d not in known) for d in devices):
+        found = get_devices(lookup_timeout)
+        if cache is not None:
+            cache.update(found)
+        known.update(found)
+
+    return [d.upper() if is_mac_address(d) else d if is_uri(d) else known.get(d) for d in devices]
+
+
+def format_seconds(x):
+    return '' if x is None else '{0:.2f}'.format(x)
+
+
+def print_fleet_results(results):
+    """ Print a table of the results of prepare_device. """
+    print_header(['Device', 'Status', 'Connect (s)', 'Configure (s)', 'Sync (s)', 'Verify (s)', 'Offset (s)', 'Error'], pad = 18)
+    for r in results:
+        print_header([str(r['name'] or r['device']),
+                      r['status'],
+                      format_seconds(r['connect']),
+                      format_seconds(r['configure']),
+                      format_seconds(r['sync']),
+                      format_seconds(r['verify']),
+                      '' if r['time_offset'] is None else '{0:.1f}'.format(r['time_offset']),
+                      r['error']], pad = 18)
+
+
+def fleet_cli(argv = None):
+    parser = argparse.ArgumentParser(prog = "faros fleet", description = "Configure and synchronise the time of the Faros devices listed in a manifest.")
+    parser.add_argument("manifest", help="CSV file with the devices (address or name) and their settings.")
+    parser.add_argument("--workers", dest = "workers", type = int, help="Number of devices prepared at the same time. Default is 4.", default = 4)
+    parser.add_argument("--no-sync-time", action = "store_true", dest = "no_sync_time", help="Do not set the time of the devices.")
+    parser.add_argument("--time-tolerance", dest = "time_tolerance", type = float, help="Largest accepted difference between the device and computer time in seconds. Default is 2.", default = 2.0)
+    parser.add_argument("--device-list", dest = "device_list", help="File containing the names and bluetooth addresses of devices (see faros --scan).")
+    parser.add_argument("--lookup-timeout", dest = "lookup_timeout", type = float, help="Time to wait for the name of each device when scanning, in seconds. Default is 10.", default = 10)
+    parser.add_argument("--cache", dest = "cache", help="Device cache file. Default is ~/.cache/faros-streamer/devices.json.", default = None)
+    parser.add_argument("--cache-ttl", dest = "cache_ttl", type = float, help="Ignore cached devices not found by a scan within this many seconds. Default is one week.", default = CACHE_TTL)
+    parser.add_argument("--no-cache", action = "store_true", dest = "no_cache", help="Do not use the device cache.")
+    parser.add_argument("--output", dest = "output", help="Also write the results into this CSV file.", default = None)
+
+    args = parser.parse_args(argv)
+
+    manifest = read_manifest(args.manifest)
+    cache    = None if args.no_cache else DeviceCache(args.cache, args.cache_ttl)
+
+    if args.device_list is not None:
+        device_list = read_device_list(args.device_list)
+    else:
+        device_list = None
+
+    macs = resolve_devices([m['device'] for m in manifest], device_list, cache, args.lookup_timeout)
+
+    print("Preparing {0} devices.\n".format(len(manifest)))
+    t0 = time.time()
+
+    results = [None] * len(manifest)
+    with ThreadPoolExecutor(max_workers = max(1, args.workers)) as pool:
+        futures = {}
+        for i, (m, mac) in enumerate(zip(manifest, macs)):
+            futures[pool.submit(prepare_device, m['device'], mac, m['settings'], not args.no_sync_time, cache, args.time_tolerance)] = i
+        for future in futures:
+            results[futures[future]] = future.result()
+
+    print_fleet_results(results)
+    print("")
+    n_failed = sum(r['status'] != 'ok' for r in results)
+    print_kv("Devices prepared", len(results) - n_failed)
+    print_kv("Devices failed", n_failed)
+    print_kv("Time (s)", round(time.time() - t0, 1))
+
+    if args.output is not None:
+        with open(args.output, 'w', newline = '') as f:
+            writer = csv.DictWriter(f, fieldnames = list(results[0].keys()) if results else ['device'])
+            writer.writeheader()
+            for r in results:
+                writer.writerow(r)
+
+    return n_failed == 0
@@ -9,12 +9,13 @@
 #
 # Please see the file LICENSE for details.
 
-import bluetooth
-from construct import Struct, Byte, BitStruct, Int32ul, Array, Int16sl
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
 import struct
-import crc16
 import time
+import numpy as np
+from .crc import crc16xmodem, crc16xmodem_frames, check_frames, get_packet_crc
+from .device import FarosDevice, AsyncFarosDevice, get_device, recv_exact, decode_response, encode_time
 
 # -------------------------------------------------------------------------------
 # Functions for printing
@@ -36,18 +37,45 @@ def sync_time(s):
     print("-" * 45)
     print("")
 
-def get_devices():
+def lookup_names(addresses, timeout = 10, max_workers = 8):
+    """ Look up the names of bluetooth devices concurrently, waiting
+        at most timeout seconds for each device. Returns a dictionary
+        with the names of the addresses that answered.
+    """
+    out = {}
+    if len(addresses) == 0:
+        return(out)
+
+    import bluetooth
+    pool    = ThreadPoolExecutor(max_workers = min(max_workers, len(addresses)))
+    futures = {pool.submit(bluetooth.lookup_name, bdaddr, timeout) : bdaddr for bdaddr in addresses}
+    done, pending = wait(futures, timeout = timeout + 1)
+    for future in done:
+        try:
+            name = future.result()
+        except Exception:
+            name = None
+        if name:
+            out[futures[future]] = name
+    pool.shutdown(wait = False)
+
+    return(out)
+
+
+def get_devices(lookup_timeout = 10):
     """ Search for bluetooth devices and return
         a dictionary with the names and bluetooth addresses
         of the found devices.
     """
+    import bluetooth
     print("Scanning for available devices.")
     nearby_devices = bluetooth.discover_devices()
+    names = lookup_names(nearby_devices, timeout = lookup_timeout)
     out = {}
     for bdaddr in nearby_devices:
-        name = bluetooth.lookup_name(bdaddr)
-        out[name] = bdaddr
-    if out is not None:
+        if bdaddr in names:
+            out[names[bdaddr]] = bdaddr
+    if out:
         print("Found the following devices:")
         print_devices(out)
         print("")
@@ -97,6 +125,40 @@ def print_properties(x):
     print("-" * 45)
     print("")
 
+def print_statistics(x):
+    """ Print a formatted summary of streaming statistics
+        (see StreamerThread.get_statistics).
+    """
+    print("-" * 45)
+    print("Streaming statistics")
+    print("-" * 45)
+    if x.get('device') is not None:
+        print_kv("Device", x['device'])
+    print_kv("Packets received", x['packets'])
+    print_kv("Packets lost", x['lost_packets'])
+    print_kv("Duplicate packets", x['duplicate_packets'])
+    print_kv("Out-of-order packets", x['reordered_packets'])
+    print_kv("Checksum errors", x['crc_errors'])
+    print_kv("Resynchronisations", x['resyncs'])
+    print_kv("Skipped bytes", x['skipped_bytes'])
+    if x['clock_drift_ppm'] is not None:
+        print_kv("Clock drift (ppm)", round(x['clock_drift_ppm'], 1))
+    if x.get('reconnects'):
+        print_kv("Reconnections", x['reconnects'])
+        print_kv("Packets lost reconnecting", x['reconnect_lost'])
+    if x.get('battery_high') is not None:
+        print_kv("Battery flags (h/l)", "{0}/{1}".format(x['battery_high'], x['battery_low']))
+    print("")
+    print_kv("Time reading (s)", round(x['read_time'], 3))
+    print_kv("Time decoding (s)", round(x['decode_time'], 3))
+    print_kv("Time pushing (s)", round(x['push_time'], 3))
+    print_kv("Max. decode queue", x['decode_queue_max'])
+    print_kv("Max. push queue", x['push_queue_max'])
+    print_kv("Dropped (decode queue)", x['decode_dropped'])
+    print_kv("Dropped (push queue)", x['push_dropped'])
+    print("-" * 45)
+    print("")
+
 # -------------------------------------------------------------------------------
 # Functions for getting and manipulating device properties (settings)
 # -------------------------------------------------------------------------------
@@ -104,13 +166,11 @@ def print_properties(x):
 def get_properties(s):
     """ Get properties (name, firmware veersion and build date, and settings)
         of a Faros device connected to socket s.
-    """
-    properties = ['name', 'firmware-version', 'firmware-build', 'device_time', 'settings']
-    out = {}
-    for p in properties:
-        out[p] = get_property(s, p)
 
-    return(out)
+        All requests are sent at once and the answers read in order
+        (see FarosDevice.get_properties).
+    """
+    return get_device(s).get_properties()
 
 
 def get_ecg_str_fs(s = None):
@@ -180,6 +240,10 @@ def get_temp_str(s):
     return {'0' : 'off', '1' : 'on'}[s]
 
 
+# Duration of one packet in seconds (each packet holds fs / 5 samples)
+PACKET_DURATION = 0.2
+
+
 def get_packet_size(settings):
     """ Return the packet size given the settings of the device. """
     n_ecg_s = int(settings['ecg_fs']) / 5
@@ -222,6 +286,64 @@ def get_packet_size(settings):
            'n_padd'   : int(n_padd)}
         
     return(out)
+
+
+class PacketLayout(object):
+    """ Immutable description of the packets sent by a Faros device
+        with the given settings (as returned by unpack_settings).
+
+        The byte ranges of the different parts of a packet are stored
+        as slice objects (header, ecg, acc, marker, rr, temp, padding
+        and crc), so a packet can be taken apart without any further
+        arithmetic. Parts that are not present are empty slices.
+    """
+    __slots__ = ('size',
+                 'n_ecg_c', 'n_ecg_s', 'n_acc_s', 'n_rr_s', 'n_temp_s', 'n_padd',
+                 'header', 'ecg', 'acc', 'marker', 'rr', 'temp', 'padding', 'crc',
+                 'dtype')
+
+    def __init__(self, settings):
+        packet_size = get_packet_size(settings)
+        ps          = packet_size['ps']
+
+        b_ecg    = 8
+        b_acc    = b_ecg + packet_size['ecg_ps']
+        b_marker = b_acc + packet_size['acc_ps']
+        b_rr     = b_marker + 2
+        b_temp   = b_rr + 2 * packet_size['n_rr_s']
+        b_padd   = b_temp + 2 * packet_size['n_temp_s']
+
+        values = {'size'     : ps,
+                  'n_ecg_c'  : packet_size['n_ecg_c'],
+                  'n_ecg_s'  : packet_size['n_ecg_s'],
+                  'n_acc_s'  : packet_size['n_acc_s'],
+                  'n_rr_s'   : packet_size['n_rr_s'],
+                  'n_temp_s' : packet_size['n_temp_s'],
+                  'n_padd'   : packet_size['n_padd'],
+
+                  'header'   : slice(0, b_ecg),
+                  'ecg'      : slice(b_ecg, b_acc),
+                  'acc'      : slice(b_acc, b_marker),
+                  'marker'   : slice(b_marker, b_rr),
+                  'rr'       : slice(b_rr, b_temp),
+                  'temp'     : slice(b_temp, b_padd),
+                  'padding'  : slice(b_padd, ps - 2),
+                  'crc'      : slice(ps - 2, ps),
+
+                  'dtype'    : get_packet_dtype(packet_size)}
+
+        for k in values:
+            object.__setattr__(self, k, values[k])
+
+    def __setattr__(self, name, value):
+        raise AttributeError("PacketLayout is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("PacketLayout is immutable")
+
+    def __repr__(self):
+        return "PacketLayout(size={0}, n_ecg_c={1}, n_ecg_s={2}, n_acc_s={3}, n_rr_s={4}, n_temp_s={5})".format(
+            self.size, self.n_ecg_c, self.n_ecg_s, self.n_acc_s, self.n_rr_s, self.n_temp_s)
     
 
 def inv_lookup(d, v):
@@ -278,6 +400,7 @@ def unpack_settings(s):
 
 def connect(addr):
     """ Connect to a device using the bluetooth address addr. """
+    import bluetooth
     port = 1
     s = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
     s.connect((addr, port))
@@ -290,6 +413,25 @@ def disconnect(s):
     s.close()
 
     
+def get_recv_into(s):
+    """ Return a function that reads data from socket s into a writable
+        buffer and returns the number of bytes read.
+
+        Sockets without recv_into (e.g., older PyBluez sockets) fall
+        back to recv followed by a copy into the buffer.
+    """
+    if hasattr(s, 'recv_into'):
+        return s.recv_into
+
+    def recv_into(buf):
+        data = s.recv(len(buf))
+        n    = len(data)
+        buf[0:n] = data
+        return n
+
+    return recv_into
+
+
 def send_command(s, command, r_length = 0, decode = True):
     """ Send a command to a Faros device.
 
@@ -298,17 +440,38 @@ def send_command(s, command, r_length = 0, decode = True):
         r_length : response length (if any). Default is 0 (no response)
         decode   : should the response data be decoded to ASCII
     """
-    data = None
-    s.send(command + '\r')
+    data = get_device(s).command(command, r_length)
+    if not r_length:
+        return None
+    return decode_response(data) if decode else data
+
+
+def send_commands(s, commands):
+    """ Send several commands to a Faros device at once and read the
+        responses, saving a round trip for each command. The device
+        answers the commands in order.
+
+        commands is a list of (command, response length, decode), see
+        send_command. Returns a list of the responses.
+    """
+    res = get_device(s).commands([(c[0], c[1], b'') for c in commands])
+
+    out = []
+    for (command, r_length, decode), data in zip(commands, res):
+        if not r_length:
+            data = None
+        elif decode:
+            data = decode_response(data)
+        out.append(data)
+    return(out)
+
 
-    if r_length:
-        data = s.recv(r_length)
-        if decode:
-            try:
-                data = data.decode("UTF-8").strip()
-            except UnicodeDecodeError:
-                data = None
-    return(data)
+# The command, response length and decoding of each device property
+PROPERTY_COMMANDS = {'firmware-version': ['wbainf', 9, True],
+                     'firmware-build': ['wbaind', 9, True],
+                     'name' : ['wbawho', 12, True],
+                     'device_time' : ['wbagdt', 8, False],
+                     'settings' : ['wbagds', 12, True]}
 
 
 def get_property(s, p):
@@ -316,37 +479,20 @@ def get_property(s, p):
         p can be 'firmware-version', 'firmware'build', 'name'
         or 'settings'.
     """
-    prop_map = {'firmware-version': ['wbainf', 9, True],
-                'firmware-build': ['wbaind', 9, True],
-                'name' : ['wbawho', 12, True],
-                'device_time' : ['wbagdt', 8, False],
-                'settings' : ['wbagds', 12, True]}
-
-    if p in prop_map.keys():
-        res = send_command(s, prop_map[p][0], prop_map[p][1], prop_map[p][2])
-        if (p == 'name') and res.startswith('FAROS'):
-                res += s.recv(2).decode("UTF-8").strip()
-        return res
+    if p == 'name':
+        return get_device(s).get_name()
+    elif p in PROPERTY_COMMANDS.keys():
+        return send_command(s, *PROPERTY_COMMANDS[p])
     else:
         return None
 
 def set_device_time(s):
     """ Set current device time. """
-    current_time = int(time.time())
-    current_time += (-time.timezone)
-
-    ct_bytes = struct.pack('i', current_time)
-
-    s.send('wbasdt')
-    s.send(ct_bytes)
-    s.send('\r')
-
-    data = s.recv(7)
-    return data
+    return get_device(s).command('wbasdt', argument = encode_time())
 
 def binary_time_to_unix_time(x):
     """ Convert Faros binary time to UNIX time. """
-    device_time_bytes = x[3:].strip()
+    device_time_bytes = x[3:7]
     return float(struct.unpack("<L", device_time_bytes)[0])
 
 def unix_time_to_ts(x):
@@ -359,26 +505,24 @@ def binary_time_to_str(x):
 
 def get_device_time(s):
     """ Get current device time. """
-    s.send('wbagdt' + '\r')
-    data = s.recv(8)
-    
-    return binary_time_to_str(data)
+    return binary_time_to_str(get_device(s).command('wbagdt'))
     
 
 # -------------------------------------------------------------------------------
 # Unpack the data received from a Faros device
 # -------------------------------------------------------------------------------
 
+def to_samples(block):
+    """ Return a (channels, samples) block of a packet (see
+        get_packet_dtype) as a C-contiguous (samples, channels) array,
+        which is the layout expected by push_chunk.
+    """
+    return np.ascontiguousarray(block.T)
+
+
 def unpack_data(packet,
-                packet_size,
-                p_header,
-
-                p_ecg         = None,
-                p_acc         = None,
-                p_marker      = None,
-                p_rr          = None,
-                p_temp        = None,
-          
+                layout,
+
                 outlet_ecg    = None,
                 outlet_acc    = None,
                 outlet_marker = None,
@@ -388,82 +532,335 @@ def unpack_data(packet,
         stream the data over the Lab Streaming Layer
         (LSL).
     """
-    
+    push_data(decode_packets(packet, layout)[0],
+              layout,
+              outlet_ecg,
+              outlet_acc,
+              outlet_marker,
+              outlet_rr,
+              outlet_temp)
+
+
+def push_data(data,
+              layout,
+
+              outlet_ecg    = None,
+              outlet_acc    = None,
+              outlet_marker = None,
+              outlet_rr     = None,
+              outlet_temp   = None,
+
+              timestamp     = 0.0):
+    """ Stream one decoded packet (a record returned by decode_packets)
+        over the Lab Streaming Layer (LSL).
+
+        timestamp is the LSL time at the end of the packet, i.e., one
+        sample period after its last sample. If it is 0.0, LSL stamps
+        the data with the time of pushing.
+    """
+    if timestamp:
+        ts_ecg = timestamp - PACKET_DURATION / layout.n_ecg_s if layout.n_ecg_s else 0.0
+        ts_acc = timestamp - PACKET_DURATION / layout.n_acc_s if layout.n_acc_s else 0.0
+    else:
+        ts_ecg = ts_acc = 0.0
+
     # (0) ----- Header -----
-    header = p_header.parse(packet[0:8])
+    flag = data['flag']
 
     # (1) ----- ECG -----
-    if p_ecg is not None:
-        ecg = p_ecg.parse(packet[8:(8 + packet_size['ecg_ps'])])['ecg']
-
-        if int(packet_size['n_ecg_c']) > 1:
-            ecg = [ecg[i::packet_size['n_ecg_s']] for i in range(packet_size['n_ecg_s'])]
-        
-
     if outlet_ecg is not None:
-        outlet_ecg.push_chunk(ecg)
+        outlet_ecg.push_chunk(to_samples(data['ecg']), ts_ecg)
 
     # (2) ----- Accelerometer -----
-    if p_acc is not None:
-        acc = p_acc.parse(packet[(8 + packet_size['ecg_ps']):(8 + packet_size['ecg_ps'] + packet_size['acc_ps'])])['acc']
-        acc = [acc[i::packet_size['n_acc_s']] for i in range(packet_size['n_acc_s'])]
-
     if outlet_acc is not None:
-        outlet_acc.push_chunk(acc)
+        outlet_acc.push_chunk(to_samples(data['acc']), ts_acc)
 
     # (3) ----- Marker -----
-    b1 = 8 + packet_size['ecg_ps'] + packet_size['acc_ps']
-    b2 = b1 + 2
-    marker = p_marker.parse(packet[b1:b2])['marker']
-    if marker[0] > 0:
-        outlet_marker.push_sample([1])
+    if data['marker'] > 0:
+        outlet_marker.push_sample([1], timestamp)
 
     # (4) ----- RR -----
-    if p_rr is not None:
-        b1 = 10 + packet_size['ecg_ps'] + packet_size['acc_ps']
-        b2 = b1 + 2
-        rr = p_rr.parse(packet[b1:b2])['rr'][0]
-        if header['flag']['rr_in_packet']:
-            outlet_rr.push_sample([rr])
-        
+    if layout.n_rr_s > 0:
+        if flag & FLAG_RR_IN_PACKET:
+            outlet_rr.push_sample([int(data['rr'])], timestamp)
+
     # (5) ----- Temperature -----
-    if p_temp is not None:
-        b1 = 10 + packet_size['ecg_ps'] + packet_size['acc_ps'] + 2 * packet_size['n_rr_s']
-        b2 = b1 + 2
-        temp = p_temp.parse(packet[b1:b2])['temp'][0]
+    if layout.n_temp_s > 0:
         # convert raw ADC values to degrees Celsius
-        temp = temp * (-(158.3488 + 53.3361)/4095) + 158.3488
-        outlet_temp.push_sample([temp])
-
-    # (6) ----- The packet checksum -----
-    #
-    # p_crc = Struct('packet_format', Array(1, ULInt16('crc')))
-    # crc   = p_crc.parse(packet[-2:])['crc'][0]
-    # crc2  = crc16.crc16xmodem(packet[:-2])
-    # print(crc - crc2)
-    
+        temp = data['temp'] * (-(158.3488 + 53.3361)/4095) + 158.3488
+        outlet_temp.push_sample([float(temp)], timestamp)
+
+
+def push_gap(n_packets,
+             layout,
+             fill_value,
+
+             outlet_ecg    = None,
+             outlet_acc    = None,
+
+             timestamp     = 0.0,
+             dtype         = np.int16):
+    """ Stream fill_value (e.g. 0 or NaN) in place of the ECG and
+        accelerometer samples of n_packets lost packets, so that the
+        number of samples in the LSL streams matches the elapsed time.
+        timestamp is the LSL time at the end of the last lost packet
+        (see push_data). dtype is the channel format of the outlets
+        (float32 for NaN).
+    """
+    if timestamp:
+        ts_ecg = timestamp - PACKET_DURATION / layout.n_ecg_s if layout.n_ecg_s else 0.0
+        ts_acc = timestamp - PACKET_DURATION / layout.n_acc_s if layout.n_acc_s else 0.0
+    else:
+        ts_ecg = ts_acc = 0.0
+
+    if outlet_ecg is not None:
+        outlet_ecg.push_chunk(np.full((n_packets * layout.n_ecg_s, layout.n_ecg_c), fill_value, dtype = dtype), ts_ecg)
+
+    if outlet_acc is not None:
+        outlet_acc.push_chunk(np.full((n_packets * layout.n_acc_s, 3), fill_value, dtype = dtype), ts_acc)
+
+
+def decode_packets(data, layout):
+    """ Decode one or more consecutive packets in data (bytes, bytearray or
+        memoryview) without copying. Returns a structured NumPy array with
+        one record per packet; see get_packet_dtype for the fields.
+    """
+    return np.frombuffer(data, dtype = layout.dtype)
+
     
+class PacketFramer(object):
+    """ Split the byte stream from a Faros device into packets.
+
+        The data read from the device is given to feed, which returns
+        the complete, valid packets as memoryviews into the buffer that
+        was read, without copying. Only packets split between two
+        reads are copied into a preallocated buffer holding n_packets
+        packets. A packet is only valid until its buffer is reused, so
+        it must be decoded (or copied) before that.
+
+        If a packet has a bad signature or checksum, the buffer is
+        scanned for the next signature and decoding continues from
+        there. The number of discarded bytes is stored in skipped_bytes
+        and the number of times synchronisation was lost in resyncs.
+        Packets with a correct signature but a bad checksum at the
+        position of the next packet are counted in crc_errors.
+    """
+    def __init__(self, layout, n_packets = 4):
+        self.layout = layout
+        self.buffer = bytearray(layout.size * n_packets)
+        self.view   = memoryview(self.buffer)
+        self.start  = 0
+        self.end    = 0
+
+        self.synced        = True
+        self.crc_errors    = 0
+        self.skipped_bytes = 0
+        self.resyncs       = 0
+
+    def __len__(self):
+        """ Number of buffered bytes not yet returned as packets. """
+        return self.end - self.start
+
+    def write(self, data):
+        """ Copy as much of data into the buffer as fits. Returns the
+            number of bytes copied.
+        """
+        if self.end == len(self.buffer):
+            self.compact()
+        n = min(len(data), len(self.buffer) - self.end)
+        self.view[self.end:(self.end + n)] = data[0:n]
+        self.end += n
+        return n
+
+    def compact(self):
+        """ Move the buffered bytes to the beginning of the buffer. """
+        n = self.end - self.start
+        if self.start > 0:
+            self.view[0:n] = self.view[self.start:self.end]
+        self.start = 0
+        self.end   = n
+
+    def clear(self):
+        """ Discard all buffered data. """
+        self.start = 0
+        self.end   = 0
+
+    def is_valid(self, packet):
+        """ Check the signature and checksum of a packet. A bad checksum
+            is counted only for a packet where the next packet was
+            expected, not for signatures found in the data while
+            resynchronising.
+        """
+        if packet[0:3] != b'MEP':
+            return False
+        if crc16xmodem(packet[:-2]) != get_packet_crc(packet):
+            if self.synced:
+                self.crc_errors += 1
+            return False
+        return True
+
+    def resync(self):
+        """ Skip to the next packet signature after the current position.
+            Bytes that may still be the start of a signature are kept.
+        """
+        pos = self.buffer.find(b'MEP', self.start + 1, self.end)
+        if pos < 0:
+            pos = max(self.start + 1, self.end - 2)
+        self.skipped_bytes += pos - self.start
+        self.start          = pos
+
+    def feed(self, buf, n):
+        """ Yield all complete and valid packets in the first n bytes
+            of buf (a bytearray), continuing the data given earlier.
+        """
+        ps   = self.layout.size
+        view = memoryview(buf)
+        pos  = 0
+
+        while pos < n:
+            buffered = self.end - self.start
+            if buffered > 0:
+                # complete the packet started in an earlier buffer
+                k = ps - buffered
+            elif (n - pos) < ps:
+                k = n - pos
+            else:
+                packet = view[pos:(pos + ps)]
+                if self.is_valid(packet):
+                    pos        += ps
+                    self.synced = True
+                    yield packet
+                    continue
+                if self.synced:
+                    self.resyncs += 1
+                    self.synced   = False
+                # skip to the next packet signature, as in resync
+                pos2 = buf.find(b'MEP', pos + 1, n)
+                if pos2 < 0:
+                    pos2 = max(pos + 1, n - 2)
+                self.skipped_bytes += pos2 - pos
+                pos                 = pos2
+                continue
+
+            pos += self.write(view[pos:min(pos + k, n)])
+            for packet in self.packets():
+                yield packet
+
+    def packets(self):
+        """ Yield all complete and valid packets in the buffer. """
+        ps = self.layout.size
+        while (self.end - self.start) >= ps:
+            packet = self.view[self.start:(self.start + ps)]
+            if self.is_valid(packet):
+                self.start += ps
+                self.synced = True
+                yield packet
+            else:
+                if self.synced:
+                    self.resyncs += 1
+                    self.synced   = False
+                self.resync()
+
+
+class PacketCounter(object):
+    """ Track the continuity of the packet numbers of one device.
+
+        Every packet carries a 32-bit packet number that increases by
+        one for each packet. Gaps are counted as lost packets, repeated
+        numbers as duplicates and numbers older than the latest one as
+        out-of-order packets. Duplicate and out-of-order packets
+        should be dropped, as their samples have already been accounted
+        for.
+    """
+    def __init__(self):
+        self.packet_number     = None
+        self.packets           = 0
+        self.lost_packets      = 0
+        self.duplicate_packets = 0
+        self.reordered_packets = 0
+
+    def update(self, packet_number):
+        """ Register a received packet. Return the number of packets
+            lost before this one, or -1 if the packet should be dropped.
+        """
+        if self.packet_number is None:
+            gap = 0
+        else:
+            delta = (packet_number - self.packet_number) & 0xFFFFFFFF
+            if delta == 0:
+                self.duplicate_packets += 1
+                return -1
+            if delta >= 0x80000000:
+                self.reordered_packets += 1
+                return -1
+            gap = delta - 1
+
+        self.packet_number  = packet_number
+        self.packets       += 1
+        self.lost_packets  += gap
+        return gap
+
+    def is_old(self, packet_number):
+        """ Is the packet number the same as or older than the latest
+            one (see update), without registering the packet.
+        """
+        if self.packet_number is None:
+            return False
+        delta = (packet_number - self.packet_number) & 0xFFFFFFFF
+        return (delta == 0) or (delta >= 0x80000000)
+
+    def restart(self):
+        """ Forget the latest packet number, e.g., after the device has
+            started numbering its packets from zero again.
+        """
+        self.packet_number = None
+
+
 # -------------------------------------------------------------------------------
 # Define Faros packet formats
 # -------------------------------------------------------------------------------
 
-def get_packet_header():
-    
-        return Struct(
-            "sig_1" / Byte,
-            "sig_2" / Byte,
-            "sig_3" / Byte,
-            "flag" / BitStruct(
-                "battery_h" / Byte,
-                "battery_l" / Byte,
-                "rr_error" / Byte,
-                "dummy_4" / Byte,
-                "dummy_3" / Byte,
-                "dummy_2" / Byte,
-                "dummy_1" / Byte,
-                "rr_in_packet" / Byte),
-            "packet_number" / Int32ul)
-
-
-def get_data_packet(N, name):
-    return Struct(name / Array(N, Int16sl))
+# Bits of the header flag byte
+FLAG_BATTERY_H    = 0x80
+FLAG_BATTERY_L    = 0x40
+FLAG_RR_ERROR     = 0x20
+FLAG_RR_IN_PACKET = 0x01
+
+
+def get_packet_dtype(packet_size):
+    """ Return a NumPy structured dtype describing a whole packet
+        given the packet size (see get_packet_size).
+
+        The ECG and accelerometer fields are stored channel by channel
+        in the packet and have the shapes (n_ecg_c, n_ecg_s) and
+        (3, n_acc_s), respectively, i.e., all samples of the first
+        channel come first. Use to_samples to get (samples, channels).
+        Fields for modalities that are not recorded are left out.
+    """
+    fields = [('sig', 'S3'),
+              ('flag', 'u1'),
+              ('packet_number', '<u4')]
+
+    if packet_size['n_ecg_s'] > 0:
+        fields.append(('ecg', '<i2', (packet_size['n_ecg_c'], packet_size['n_ecg_s'])))
+
+    if packet_size['n_acc_s'] > 0:
+        fields.append(('acc', '<i2', (3, packet_size['n_acc_s'])))
+
+    fields.append(('marker', '<i2'))
+
+    if packet_size['n_rr_s'] > 0:
+        fields.append(('rr', '<i2'))
+
+    if packet_size['n_temp_s'] > 0:
+        fields.append(('temp', '<i2'))
+
+    # reserved bytes and padding up to the checksum
+    n_used   = 8 + packet_size['ecg_ps'] + packet_size['acc_ps'] + 2 + 2 * packet_size['n_rr_s'] + 2 * packet_size['n_temp_s']
+    fields.append(('padding', 'V' + str(packet_size['ps'] - n_used - 2)))
+    fields.append(('crc', '<u2'))
+
+    out = np.dtype(fields)
+    assert out.itemsize == packet_size['ps']
+
+    return(out)
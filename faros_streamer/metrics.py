@@ -0,0 +1,209 @@
+# This file is part of Faros Streamer.
+#
+# Copyright 2015
+# Andreas Henelius <andreas.henelius@ttl.fi>,
+# Finnish Institute of Occupational Health
+#
+# This code is released under the MIT License
+# http://opensource.org/licenses/mit-license.php
+#
+# Please see the file LICENSE for details.
+
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from bisect import bisect_left
+import threading
+import time
+
+# -------------------------------------------------------------------------------
+# Streaming metrics
+#
+# Counters and gauges are read from StreamerThread.get_statistics when
+# the metrics are requested, so they cost nothing while streaming. Only
+# the histograms are updated for every item, which takes a bisection
+# and two additions.
+# -------------------------------------------------------------------------------
+
+# Upper bounds (in seconds) of the buckets of the latency histograms
+LATENCY_BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5]
+
+
+class Histogram(object):
+    """ A histogram with fixed buckets, as in Prometheus.
+
+        counts[i] is the number of observations x with
+        buckets[i - 1] < x <= buckets[i]; the last element counts the
+        observations larger than all buckets. Only one thread should
+        call observe.
+    """
+    def __init__(self, buckets = LATENCY_BUCKETS):
+        self.buckets = list(buckets)
+        self.counts  = [0] * (len(self.buckets) + 1)
+        self.sum     = 0.0
+        self.count   = 0
+
+    def observe(self, x):
+        self.counts[bisect_left(self.buckets, x)] += 1
+        self.sum   += x
+        self.count += 1
+
+    def quantile(self, q):
+        """ Return an upper bound of the q-quantile (0 <= q <= 1), or
+            None if there are no observations.
+        """
+        if self.count == 0:
+            return None
+        target = q * self.count
+        n      = 0
+        for i, c in enumerate(self.counts[0:-1]):
+            n += c
+            if n >= target:
+                return self.buckets[i]
+        return float('inf')
+
+
+# The statistics (see StreamerThread.get_statistics) exported as
+# metrics: key, metric name, type and description
+METRICS = [('packets',           'faros_packets_total',              'counter', 'Packets received.'),
+           ('lost_packets',      'faros_lost_packets_total',         'counter', 'Packets lost, based on the packet numbers.'),
+           ('duplicate_packets', 'faros_duplicate_packets_total',    'counter', 'Duplicate packets.'),
+           ('reordered_packets', 'faros_reordered_packets_total',    'counter', 'Out-of-order packets.'),
+           ('crc_errors',        'faros_crc_errors_total',           'counter', 'Packets with a bad checksum.'),
+           ('resyncs',           'faros_resyncs_total',              'counter', 'Times the packet synchronisation was lost.'),
+           ('skipped_bytes',     'faros_skipped_bytes_total',        'counter', 'Bytes skipped while resynchronising.'),
+           ('read_time',         'faros_read_seconds_total',         'counter', 'Time spent reading from the device.'),
+           ('decode_time',       'faros_decode_seconds_total',       'counter', 'Time spent decoding packets.'),
+           ('push_time',         'faros_push_seconds_total',         'counter', 'Time spent pushing data to LSL.'),
+           ('decode_dropped',    'faros_decode_dropped_total',       'counter', 'Items dropped from the decode queue.'),
+           ('push_dropped',      'faros_push_dropped_total',         'counter', 'Items dropped from the push queue.'),
+           ('decode_queue',      'faros_decode_queue',               'gauge',   'Items in the decode queue.'),
+           ('decode_queue_max',  'faros_decode_queue_max',           'gauge',   'Largest number of items in the decode queue.'),
+           ('push_queue',        'faros_push_queue',                 'gauge',   'Items in the push queue.'),
+           ('push_queue_max',    'faros_push_queue_max',             'gauge',   'Largest number of items in the push queue.'),
+           ('clock_drift_ppm',   'faros_clock_drift_ppm',            'gauge',   'Drift of the device clock relative to the LSL clock.'),
+           ('packet_age',        'faros_last_packet_age_seconds',    'gauge',   'Time since the latest packet was received.'),
+           ('battery_high',      'faros_battery_high',               'gauge',   'battery_h flag of the latest packet.'),
+           ('battery_low',       'faros_battery_low',                'gauge',   'battery_l flag of the latest packet.')]
+
+# The histograms of a StreamerThread: attribute path, metric name and description
+HISTOGRAMS = [(('decoder', 'histogram'), 'faros_decode_item_seconds', 'Time to decode the data of one read.'),
+              (('sink', 'histogram'),    'faros_push_item_seconds',   'Time to push the data of one packet to LSL.'),
+              (('sink', 'latency'),      'faros_latency_seconds',     'Time from receiving a packet to pushing its data to LSL.')]
+
+
+def format_labels(labels):
+    return '{' + ','.join('{0}="{1}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels) + '}'
+
+
+def render_metrics(streamers):
+    """ Return the metrics of a list of StreamerThreads in the
+        Prometheus text format.
+    """
+    stats  = [s.get_statistics() for s in streamers]
+    labels = [[('device', x['device'] if x['device'] is not None else '')] for x in stats]
+    out    = []
+
+    for key, name, kind, text in METRICS:
+        out.append('# HELP {0} {1}'.format(name, text))
+        out.append('# TYPE {0} {1}'.format(name, kind))
+        for x, l in zip(stats, labels):
+            if x.get(key) is not None:
+                out.append('{0}{1} {2}'.format(name, format_labels(l), float(x[key])))
+
+    for path, name, text in HISTOGRAMS:
+        out.append('# HELP {0} {1}'.format(name, text))
+        out.append('# TYPE {0} histogram'.format(name))
+        for s, l in zip(streamers, labels):
+            h = getattr(getattr(s, path[0]), path[1])
+            n = 0
+            for b, c in zip(h.buckets + ['+Inf'], h.counts):
+                n += c
+                out.append('{0}_bucket{1} {2}'.format(name, format_labels(l + [('le', b)]), n))
+            out.append('{0}_sum{1} {2}'.format(name, format_labels(l), h.sum))
+            out.append('{0}_count{1} {2}'.format(name, format_labels(l), h.count))
+
+    return '\n'.join(out) + '\n'
+
+
+class MetricsServer(threading.Thread):
+    """ Serve the metrics of a list of StreamerThreads over HTTP in the
+        Prometheus text format, at http://host:port/metrics.
+    """
+    def __init__(self, streamers, port = 9100, host = '127.0.0.1'):
+        threading.Thread.__init__(self, name = 'faros-metrics')
+        self.daemon    = True
+        self.streamers = streamers
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ['/', '/metrics']:
+                    self.send_error(404)
+                    return
+                body = render_metrics(server.streamers).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = HTTPServer((host, port), Handler)
+
+    def run(self):
+        self.httpd.serve_forever()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+# Channels of the LSL status stream
+STATUS_CHANNELS = ['packets_per_s', 'lost_packets', 'crc_errors', 'resyncs',
+                   'decode_queue', 'push_queue', 'latency_p99_ms',
+                   'battery_high', 'battery_low']
+
+
+class StatusThread(threading.Thread):
+    """ Push the STATUS_CHANNELS of each StreamerThread in streamers
+        every interval seconds to its status_outlet (an LSL outlet
+        with len(STATUS_CHANNELS) float32 channels).
+    """
+    def __init__(self, streamers, interval = 1.0):
+        threading.Thread.__init__(self, name = 'faros-status')
+        self.daemon    = True
+        self.streamers = [s for s in streamers if s.status_outlet is not None]
+        self.interval  = interval
+        self.running   = False
+
+    def run(self):
+        self.running = True
+        packets      = [0] * len(self.streamers)
+        t_last       = time.time()
+
+        while self.running:
+            time.sleep(self.interval)
+            t_now  = time.time()
+            dt     = max(t_now - t_last, 1e-6)
+            t_last = t_now
+
+            for i, s in enumerate(self.streamers):
+                x = s.get_statistics()
+                p = s.sink.latency.quantile(0.99)
+                sample = [(x['packets'] - packets[i]) / dt,
+                          x['lost_packets'],
+                          x['crc_errors'],
+                          x['resyncs'],
+                          x['decode_queue'],
+                          x['push_queue'],
+                          1e3 * p if p is not None else float('nan'),
+                          x['battery_high'] if x['battery_high'] is not None else float('nan'),
+                          x['battery_low'] if x['battery_low'] is not None else float('nan')]
+                packets[i] = x['packets']
+                s.status_outlet.push_sample(sample)
+
+    def stop(self):
+        self.running = False
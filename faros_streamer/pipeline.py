@@ -0,0 +1,157 @@
+# This file is part of Faros Streamer.
+#
+# Copyright 2015
+# Andreas Henelius <andreas.henelius@ttl.fi>,
+# Finnish Institute of Occupational Health
+#
+# This code is released under the MIT License
+# http://opensource.org/licenses/mit-license.php
+#
+# Please see the file LICENSE for details.
+
+from .metrics import Histogram
+from collections import deque
+import threading
+import time
+
+# -------------------------------------------------------------------------------
+# Building blocks for running the streaming in several threads
+# -------------------------------------------------------------------------------
+
+# What to do when an item is put into a full queue
+QUEUE_POLICIES = ['block', 'drop-oldest', 'drop']
+
+
+class BoundedQueue(object):
+    """ A queue holding at most maxsize items.
+
+        policy decides what happens when an item is put into a full queue:
+            'block'       : wait until there is room
+            'drop-oldest' : discard the oldest item in the queue
+            'drop'        : discard the new item
+
+        Discarded items are counted in dropped and passed to on_drop
+        (if given), e.g., for returning buffers to a pool. Items put
+        with force (markers) are never discarded. The largest number
+        of items in the queue is stored in max_depth.
+    """
+    def __init__(self, maxsize, policy = 'block', on_drop = None):
+        if policy not in QUEUE_POLICIES:
+            raise ValueError("Unknown queue policy: " + str(policy))
+
+        self.maxsize   = maxsize
+        self.policy    = policy
+        self.on_drop   = on_drop
+        self.items     = deque()
+        self.forced    = []
+        self.cond      = threading.Condition()
+
+        self.dropped   = 0
+        self.max_depth = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def put(self, item, force = False):
+        """ Put an item into the queue. If force is True the item is
+            always added and never discarded (used for markers such as
+            END_OF_STREAM).
+        """
+        dropped = None
+        with self.cond:
+            if force:
+                self.forced.append(item)
+            elif len(self.items) >= self.maxsize:
+                if self.policy == 'block':
+                    while len(self.items) >= self.maxsize:
+                        self.cond.wait()
+                elif self.policy == 'drop-oldest':
+                    dropped = self.pop_unforced()
+                    if dropped is not None:
+                        self.dropped += 1
+                else:
+                    self.dropped += 1
+                    dropped = item
+                    item    = None
+
+            if item is not None:
+                self.items.append(item)
+                self.max_depth = max(self.max_depth, len(self.items))
+                self.cond.notify_all()
+
+        if (dropped is not None) and (self.on_drop is not None):
+            self.on_drop(dropped)
+
+    def is_forced(self, item):
+        return any(item is x for x in self.forced)
+
+    def pop_unforced(self):
+        """ Remove and return the oldest item not put with force, or
+            None if there is none.
+        """
+        for i, item in enumerate(self.items):
+            if not self.is_forced(item):
+                del self.items[i]
+                return item
+        return None
+
+    def get(self):
+        """ Remove and return the oldest item, waiting for one if necessary. """
+        with self.cond:
+            while not self.items:
+                self.cond.wait()
+            item = self.items.popleft()
+            if self.forced and self.is_forced(item):
+                self.forced.remove(next(x for x in self.forced if x is item))
+            self.cond.notify_all()
+        return item
+
+
+# Put into a queue to tell the stage reading it to finish
+END_OF_STREAM = object()
+
+
+class Stage(threading.Thread):
+    """ A thread processing items from an input queue.
+
+        Subclasses implement process(item) and, optionally, finish(),
+        which is called after the end of the stream. The time spent
+        in process is accumulated in busy_time and its distribution
+        in histogram.
+    """
+    def __init__(self, name, queue):
+        threading.Thread.__init__(self, name = name)
+        self.daemon    = True
+        self.queue     = queue
+        self.items     = 0
+        self.busy_time = 0.0
+        self.histogram = Histogram()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is END_OF_STREAM:
+                break
+            t0 = time.perf_counter()
+            self.process(item)
+            dt              = time.perf_counter() - t0
+            self.busy_time += dt
+            self.items     += 1
+            self.histogram.observe(dt)
+        self.finish()
+
+    def process(self, item):
+        raise NotImplementedError
+
+    def finish(self):
+        pass
+
+    def get_statistics(self):
+        """ Return the number of processed items, the time spent and
+            the current, maximum and dropped items of the input queue.
+        """
+        return {'items'     : self.items,
+                'busy_time' : self.busy_time,
+                'depth'     : len(self.queue),
+                'max_depth' : self.queue.max_depth,
+                'dropped'   : self.queue.dropped}
@@ -0,0 +1,162 @@
+# This file is part of Faros Streamer.
+#
+# Copyright 2015
+# Andreas Henelius <andreas.henelius@ttl.fi>,
+# Finnish Institute of Occupational Health
+#
+# This code is released under the MIT License
+# http://opensource.org/licenses/mit-license.php
+#
+# Please see the file LICENSE for details.
+
+from .libfaros import *
+import threading
+
+# -------------------------------------------------------------------------------
+# Profiling the streaming
+#
+# The Profiler replaces methods of a StreamerThread and its stages
+# with timed versions, so nothing is measured (or slowed down) unless
+# profiling is enabled. Each call records the wall time and the CPU
+# time of the calling thread. Time spent in nested timed calls is
+# subtracted from the caller, so every stage gets its own (exclusive)
+# time, keyed by the path of stages leading to it, e.g.
+# 'decode;framing;crc'.
+# -------------------------------------------------------------------------------
+
+class Profiler(object):
+    """ Timer-based profiler for the streaming threads. """
+    def __init__(self):
+        self.stats = OrderedDict()
+        self.lock  = threading.Lock()
+        self.local = threading.local()
+
+    def enter(self, name):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        path = stack[-1][0] + ';' + name if stack else name
+        # path, start wall time, start CPU time, wall and CPU time of children
+        stack.append([path, time.perf_counter(), time.thread_time(), 0.0, 0.0])
+
+    def leave(self):
+        t_wall = time.perf_counter()
+        t_cpu  = time.thread_time()
+        stack  = self.local.stack
+        path, w0, c0, w_child, c_child = stack.pop()
+        wall   = t_wall - w0
+        cpu    = t_cpu - c0
+
+        if stack:
+            stack[-1][3] += wall
+            stack[-1][4] += cpu
+
+        with self.lock:
+            x = self.stats.get(path)
+            if x is None:
+                x = self.stats[path] = [0, 0.0, 0.0]
+            x[0] += 1
+            x[1] += wall - w_child
+            x[2] += cpu - c_child
+
+    def timed(self, name, f):
+        """ Return a version of the function f that is timed as stage name. """
+        def wrapper(*args, **kwargs):
+            self.enter(name)
+            try:
+                return f(*args, **kwargs)
+            finally:
+                self.leave()
+        return wrapper
+
+    def timed_generator(self, name, f):
+        """ Return a version of the generator function f whose iteration
+            steps are timed as stage name.
+        """
+        def wrapper(*args, **kwargs):
+            it = f(*args, **kwargs)
+            while True:
+                self.enter(name)
+                try:
+                    x = next(it)
+                except StopIteration:
+                    return
+                finally:
+                    self.leave()
+                yield x
+        return wrapper
+
+    def instrument(self, streamer):
+        """ Time the stages of a StreamerThread. The reading from the
+            device ('recv') is timed by the StreamerThread itself.
+        """
+        framer          = streamer.framer
+        framer.feed     = self.timed_generator('framing', framer.feed)
+        framer.is_valid = self.timed('crc', framer.is_valid)
+
+        decoder         = streamer.decoder
+        decoder.process = self.timed('decode', decoder.process)
+        if decoder.recorder is not None:
+            decoder.recorder.write = self.timed('record', decoder.recorder.write)
+
+        sink            = streamer.sink
+        sink.process    = self.timed('push', sink.process)
+
+        outlets = [('ecg', 'outlet_ecg'), ('acc', 'outlet_acc'), ('marker', 'outlet_marker'),
+                   ('rr', 'outlet_rr'), ('temp', 'outlet_temp')]
+        for name, attr in outlets:
+            outlet = getattr(sink, attr)
+            if outlet is not None:
+                setattr(sink, attr, TimedOutlet(self, name, outlet))
+
+        batcher = sink.batcher
+        if batcher is not None:
+            if batcher.outlet_ecg is not None:
+                batcher.outlet_ecg = sink.outlet_ecg
+            if batcher.outlet_acc is not None:
+                batcher.outlet_acc = sink.outlet_acc
+
+    def get_statistics(self):
+        """ Return a list of (path, calls, wall time, CPU time), with
+            exclusive times in seconds.
+        """
+        with self.lock:
+            return [(path, x[0], x[1], x[2]) for path, x in self.stats.items()]
+
+    def write_folded(self, path):
+        """ Write the exclusive CPU time (in microseconds) of each stage
+            in the folded stack format used by flamegraph.pl and
+            speedscope.
+        """
+        with open(path, 'w') as f:
+            for stage, calls, wall, cpu in sorted(self.get_statistics()):
+                f.write('{0} {1}\n'.format(stage, int(round(1e6 * cpu))))
+
+
+class TimedOutlet(object):
+    """ An LSL outlet whose pushes are timed as stage name. """
+    def __init__(self, profiler, name, outlet):
+        self.outlet      = outlet
+        self.push_chunk  = profiler.timed(name, outlet.push_chunk)
+        self.push_sample = profiler.timed(name, outlet.push_sample)
+
+
+def print_profile(profiler):
+    """ Print the time spent in each stage (see Profiler). """
+    stats = sorted(profiler.get_statistics())
+    total = sum(x[2] for x in stats)
+
+    print("-" * 96)
+    print("Profile (exclusive time per stage)")
+    print("-" * 96)
+    print_header(['Stage', 'Calls', 'Wall (s)', 'CPU (s)', 'Wall/call (us)', 'Wall (%)'], pad = 16)
+    for path, calls, wall, cpu in stats:
+        depth = path.count(';')
+        print_header(['  ' * depth + path.split(';')[-1],
+                      str(calls),
+                      '{0:.3f}'.format(wall),
+                      '{0:.3f}'.format(cpu),
+                      '{0:.1f}'.format(1e6 * wall / calls),
+                      '{0:.1f}'.format(100.0 * wall / total if total > 0 else 0.0)], pad = 16)
+    print("-" * 96)
+    print("")
@@ -0,0 +1,188 @@
+# This file is part of Faros Streamer.
+#
+# Copyright 2015
+# Andreas Henelius <andreas.henelius@ttl.fi>,
+# Finnish Institute of Occupational Health
+#
+# This code is released under the MIT License
+# http://opensource.org/licenses/mit-license.php
+#
+# Please see the file LICENSE for details.
+
+from .libfaros import *
+import json
+import mmap
+import os
+
+# -------------------------------------------------------------------------------
+# Raw capture files
+#
+# A capture consists of two files:
+#
+#   PATH      : a header followed by the raw packets, back to back
+#   PATH.idx  : one INDEX_DTYPE record for each packet in PATH
+#
+# The header is CAPTURE_MAGIC, the format version (uint16), the offset
+# of the first packet (uint32) and a JSON object with the device
+# properties (name, firmware version and build, settings) and the
+# packet size. All numbers are little-endian.
+# -------------------------------------------------------------------------------
+
+CAPTURE_MAGIC   = b'FAROSCAP'
+CAPTURE_VERSION = 1
+
+INDEX_DTYPE = np.dtype([('packet_number', '<u4'),
+                        ('offset', '<u8'),
+                        ('arrival_time', '<f8')])
+
+
+def get_index_path(path):
+    """ Return the path of the index file of a capture. """
+    return path + '.idx'
+
+
+def get_clock_path(path):
+    """ Return the path of the clock file of a capture (see
+        write_clock_file).
+    """
+    return path + '.clock.json'
+
+
+class CaptureWriter(object):
+    """ Write validated packets into a capture file.
+
+        properties is the dictionary returned by get_properties and
+        layout the PacketLayout of the device.
+    """
+    def __init__(self, path, properties, layout):
+        self.path   = path
+        self.layout = layout
+
+        header = OrderedDict()
+        header['name']             = properties.get('name')
+        header['firmware-version'] = properties.get('firmware-version')
+        header['firmware-build']   = properties.get('firmware-build')
+        header['settings']         = properties['settings']
+        header['packet_size']      = layout.size
+        header['start_time']       = time.time()
+        header = json.dumps(header).encode('utf-8')
+
+        # the packets start at a multiple of 16 bytes
+        self.offset = len(CAPTURE_MAGIC) + 6 + len(header)
+        self.offset = 16 * ((self.offset + 15) // 16)
+
+        self.f = open(path, 'wb')
+        self.f.write(CAPTURE_MAGIC)
+        self.f.write(struct.pack('<HI', CAPTURE_VERSION, self.offset))
+        self.f.write(header.ljust(self.offset - len(CAPTURE_MAGIC) - 6, b' '))
+
+        self.f_index  = open(get_index_path(path), 'wb')
+        self.p_index  = struct.Struct('<IQd')
+        self.packets  = 0
+
+    def write(self, packet, packet_number, arrival_time):
+        """ Write one packet and its index record. """
+        self.f.write(packet)
+        self.f_index.write(self.p_index.pack(packet_number, self.offset, arrival_time))
+        self.offset  += self.layout.size
+        self.packets += 1
+
+    def close(self):
+        self.f.close()
+        self.f_index.close()
+
+
+class CaptureReader(object):
+    """ Read a capture file using memory mapping, so that only the parts
+        that are accessed are read from disk.
+
+        header  : the device properties stored in the capture
+        layout  : the PacketLayout of the packets
+        packets : structured array (see get_packet_dtype) of all packets
+        index   : INDEX_DTYPE array with the packet numbers, file offsets
+                  and arrival times (LSL time) of the packets
+        indexed : the number of packets in the index file; the arrival
+                  times of the other packets are NaN
+        clock   : the clock calibrations of the device (see
+                  write_clock_file), or None
+    """
+    def __init__(self, path):
+        self.path = path
+        self.f    = open(path, 'rb')
+        self.mm   = mmap.mmap(self.f.fileno(), 0, access = mmap.ACCESS_READ)
+
+        if self.mm[0:len(CAPTURE_MAGIC)] != CAPTURE_MAGIC:
+            raise ValueError("Not a Faros capture file: " + path)
+
+        b1 = len(CAPTURE_MAGIC)
+        version, self.data_offset = struct.unpack('<HI', self.mm[b1:(b1 + 6)])
+        if version > CAPTURE_VERSION:
+            raise ValueError("Unsupported capture file version: " + str(version))
+
+        self.header = json.loads(self.mm[(b1 + 6):self.data_offset].decode('utf-8'))
+        self.layout = PacketLayout(unpack_settings(self.header['settings']))
+
+        # a partly written packet at the end is ignored
+        n_packets = (len(self.mm) - self.data_offset) // self.layout.size
+
+        self.packets = np.frombuffer(self.mm, dtype = self.layout.dtype, count = n_packets, offset = self.data_offset)
+
+        # a partly written record at the end is ignored
+        index_path = get_index_path(path)
+        if os.path.exists(index_path):
+            n_index = min(os.path.getsize(index_path) // INDEX_DTYPE.itemsize, n_packets)
+        else:
+            n_index = 0
+
+        if n_index == n_packets:
+            self.index = np.memmap(index_path, dtype = INDEX_DTYPE, mode = 'r', shape = (n_packets,))
+        else:
+            # the index is missing or shorter than the data, e.g., after
+            # a crash, so it is completed from the packets, without
+            # arrival times
+            self.index = np.zeros(n_packets, dtype = INDEX_DTYPE)
+            if n_index > 0:
+                self.index[0:n_index] = np.memmap(index_path, dtype = INDEX_DTYPE, mode = 'r', shape = (n_index,))
+            self.index['packet_number'][n_index:] = self.packets['packet_number'][n_index:]
+            self.index['offset'][n_index:]        = self.data_offset + self.layout.size * np.arange(n_index, n_packets)
+            self.index['arrival_time'][n_index:]  = np.nan
+        self.indexed = n_index
+
+        clock_path = get_clock_path(path)
+        if os.path.exists(clock_path):
+            with open(clock_path) as f:
+                self.clock = json.load(f)
+        else:
+            self.clock = None
+
+    def __len__(self):
+        return len(self.packets)
+
+    def get_raw(self, i):
+        """ Return packet i as a memoryview of the file. """
+        b1 = self.data_offset + i * self.layout.size
+        return memoryview(self.mm)[b1:(b1 + self.layout.size)]
+
+    def find_time(self, t):
+        """ Return the position of the first packet arriving at or after
+            LSL time t. The arrival times increase through the file.
+            Packets without an arrival time are taken to arrive last.
+        """
+        return int(np.searchsorted(self.index['arrival_time'], t, side = 'left'))
+
+    def get_window(self, t1, t2):
+        """ Return a slice selecting the packets that arrived between
+            LSL times t1 and t2.
+        """
+        return slice(self.find_time(t1), self.find_time(t2))
+
+    def close(self):
+        self.packets = None
+        self.index   = None
+        try:
+            self.mm.close()
+        except BufferError:
+            # arrays taken from the capture are still in use; the
+            # mapping is closed when they are released
+            pass
+        self.f.close()
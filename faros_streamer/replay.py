@@ -0,0 +1,92 @@
+# This file is part of Faros Streamer.
+#
+# Copyright 2015
+# Andreas Henelius <andreas.henelius@ttl.fi>,
+# Finnish Institute of Occupational Health
+#
+# This code is released under the MIT License
+# http://opensource.org/licenses/mit-license.php
+#
+# Please see the file LICENSE for details.
+
+from .libfaros import *
+from .utilities import *
+import threading
+import time
+
+# -------------------------------------------------------------------------------
+# Replaying capture files
+# -------------------------------------------------------------------------------
+
+def get_replay_times(arrival_times):
+    """ Return the time of each packet relative to the first one (in
+        seconds) when replaying packets with the given arrival times.
+        A packet without an arrival time, or arriving before the
+        previous one, follows the previous packet by one packet
+        duration.
+    """
+    if len(arrival_times) == 0:
+        return np.zeros(0)
+    dt = np.diff(np.asarray(arrival_times, dtype = np.float64))
+    dt[~(dt >= 0)] = PACKET_DURATION
+    return np.concatenate([[0.0], np.cumsum(dt)])
+
+
+class ReplayThread(threading.Thread):
+    """ Stream the packets of a capture file (a CaptureReader) through a
+        StreamerThread, which is not started itself, so that the packets
+        are framed, decoded and pushed to LSL exactly as when streaming
+        from a device.
+
+        speed : 1.0 = real time, 2.0 = twice as fast, etc.
+                0 = as fast as possible
+        start : the position of the first packet to replay
+    """
+    def __init__(self, streamer, reader, speed = 1.0, start = 0):
+        threading.Thread.__init__(self)
+        self.daemon   = True
+        self.streamer = streamer
+        self.reader   = reader
+        self.speed    = speed
+        self.start_at = start
+        self.running  = False
+
+    def run(self):
+        self.running = True
+        streamer     = self.streamer
+        reader       = self.reader
+        queue        = streamer.decoder.queue
+
+        streamer.start_stages()
+
+        # the packets are replayed at the pace at which they arrived,
+        # which also holds across reconnections, where the packet
+        # numbers may start from zero again
+        replay_times = get_replay_times(reader.index['arrival_time'][self.start_at:])
+        t0           = time.perf_counter()
+
+        for i in range(self.start_at, len(reader)):
+            if not self.running:
+                break
+
+            if self.speed > 0:
+                delay = replay_times[i - self.start_at] / self.speed
+                delay = t0 + delay - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+
+            buf    = streamer.pool.get()
+            packet = reader.get_raw(i)
+            buf[0:len(packet)] = packet
+            queue.put((buf, len(packet), local_clock()))
+
+        streamer.end_stream()
+        self.running = False
+
+    def stop(self, timeout = 2.0):
+        """ Stop replaying and wait (at most timeout seconds) for the
+            data already replayed to be pushed.
+        """
+        self.running = False
+        self.join(timeout)
+        self.streamer.sink.join(timeout)
@@ -0,0 +1,313 @@
+# This file is part of Faros Streamer.
+#
+# Copyright 2015
+# Andreas Henelius <andreas.henelius@ttl.fi>,
+# Finnish Institute of Occupational Health
+#
+# This code is released under the MIT License
+# http://opensource.org/licenses/mit-license.php
+#
+# Please see the file LICENSE for details.
+
+from .libfaros import *
+import argparse
+import random
+import select
+import socket
+import threading
+import time
+
+# -------------------------------------------------------------------------------
+# Generating Faros packets
+# -------------------------------------------------------------------------------
+
+def make_packet(layout, packet_number, marker = 0, rr = 0, temp = 2000, flag = 0):
+    """ Return a valid packet (bytes) for a device with the given
+        PacketLayout. The ECG and accelerometer channels contain
+        sine waves that continue from one packet to the next.
+    """
+    data = np.zeros(1, dtype = layout.dtype)
+
+    data['sig']           = b'MEP'
+    data['flag']          = flag
+    data['packet_number'] = packet_number
+
+    if layout.n_ecg_s > 0:
+        t = (packet_number * layout.n_ecg_s + np.arange(layout.n_ecg_s)) / (layout.n_ecg_s / PACKET_DURATION)
+        for i in range(layout.n_ecg_c):
+            data['ecg'][0, i] = np.round(1000 * np.sin(2 * np.pi * 1.2 * t + i))
+
+    if layout.n_acc_s > 0:
+        t = (packet_number * layout.n_acc_s + np.arange(layout.n_acc_s)) / (layout.n_acc_s / PACKET_DURATION)
+        for i in range(3):
+            data['acc'][0, i] = np.round(250 * np.sin(2 * np.pi * 0.3 * t + i))
+
+    data['marker'] = marker
+
+    if layout.n_rr_s > 0:
+        data['rr']    = rr
+        if rr:
+            data['flag'] |= FLAG_RR_IN_PACKET
+
+    if layout.n_temp_s > 0:
+        data['temp'] = temp
+
+    packet = bytearray(data.tobytes())
+    packet[layout.crc] = struct.pack('<H', crc16xmodem(packet[0:layout.crc.start]))
+
+    return bytes(packet)
+
+
+# -------------------------------------------------------------------------------
+# A simulated Faros device
+# -------------------------------------------------------------------------------
+
+class FarosSimulator(threading.Thread):
+    """ A simulated Faros device communicating over a socket.
+
+        The simulator answers the commands used by Faros Streamer
+        (wbaoms, wbaom7, wbagds, wbasds, wbagdt, wbasdt, wbawho,
+        wbainf, wbaind and wbaled) and, in online mode, sends valid
+        packets for its current settings.
+
+        settings      : the 8-character settings string (see mode_to_str)
+        name          : device name
+        speed         : 1.0 = real time, 2.0 = twice as fast, etc.
+                        0 = as fast as the receiver reads
+        max_packets   : stop sending after this many packets (None = never)
+        bit_error_rate: probability of flipping a bit, per byte sent
+        drop_rate     : probability of dropping a packet
+        burst_rate    : probability of sending a burst of burst_length
+                        random bytes before a packet
+        seed          : seed for the random errors
+    """
+    def __init__(self, sock,
+                 settings         = '11101101',
+                 name             = 'AATOS-0001',
+                 firmware_version = '01.02.03',
+                 firmware_build   = '20150101',
+                 speed            = 1.0,
+                 max_packets      = None,
+                 bit_error_rate   = 0.0,
+                 drop_rate        = 0.0,
+                 burst_rate       = 0.0,
+                 burst_length     = 64,
+                 seed             = None):
+        threading.Thread.__init__(self)
+        self.daemon           = True
+
+        self.sock             = sock
+        self.name             = name
+        self.firmware_version = firmware_version
+        self.firmware_build   = firmware_build
+        self.speed            = speed
+        self.max_packets      = max_packets
+        self.bit_error_rate   = bit_error_rate
+        self.drop_rate        = drop_rate
+        self.burst_rate       = burst_rate
+        self.burst_length     = burst_length
+        self.random           = random.Random(seed)
+
+        self.time_offset      = 0.0
+        self.online           = False
+        self.running          = False
+        self.packet_number    = 0
+
+        self.packets_sent     = 0
+        self.packets_dropped  = 0
+        self.bit_errors       = 0
+        self.bursts           = 0
+
+        self.set_settings(settings)
+
+    def set_settings(self, settings):
+        """ Change the settings (8-character string). """
+        self.settings = settings
+        self.layout   = PacketLayout(unpack_settings('wba' + settings))
+
+    def get_time(self):
+        """ Return the device time (local time in seconds). """
+        return int(time.time() - time.timezone + self.time_offset)
+
+    def respond(self, data):
+        self.sock.sendall(data)
+
+    def handle_command(self, command, argument):
+        """ Handle one command from the host. """
+        if command == b'wbaoms':
+            self.online = False
+            self.respond(b'wbaack\r')
+        elif command == b'wbaom7':
+            self.respond(b'wbaack\r')
+            self.online     = True
+            self.next_time  = time.time()
+        elif command == b'wbagds':
+            self.respond(b'wba' + self.settings.encode('ascii') + b'\r')
+        elif command == b'wbasds':
+            try:
+                self.set_settings(argument.decode('ascii'))
+                self.respond(b'wbaack\r')
+            except (KeyError, IndexError, UnicodeDecodeError):
+                self.respond(b'wbanak\r')
+        elif command == b'wbagdt':
+            self.respond(b'wba' + struct.pack('<L', self.get_time()) + b'\r')
+        elif command == b'wbasdt':
+            self.time_offset = struct.unpack('<i', argument)[0] - (time.time() - time.timezone)
+            self.respond(b'wbaack\r')
+        elif command == b'wbawho':
+            if self.name.startswith('FAROS'):
+                self.respond(self.name.ljust(13).encode('ascii') + b'\r')
+            else:
+                self.respond(self.name.ljust(11).encode('ascii') + b'\r')
+        elif command == b'wbainf':
+            self.respond(self.firmware_version.ljust(8).encode('ascii') + b'\r')
+        elif command == b'wbaind':
+            self.respond(self.firmware_build.ljust(8).encode('ascii') + b'\r')
+        elif command == b'wbaled':
+            pass
+
+    def parse_commands(self, buf):
+        """ Handle all complete commands in buf and return the rest. """
+        while True:
+            if buf.startswith(b'wbasdt'):
+                # the time is sent as 4 binary bytes
+                if len(buf) < 11:
+                    return buf
+                self.handle_command(b'wbasdt', buf[6:10])
+                buf = buf[11:]
+                continue
+
+            i = buf.find(b'\r')
+            if i < 0:
+                return buf
+            line = buf[0:i]
+            buf  = buf[(i + 1):]
+            if len(line) >= 6:
+                self.handle_command(line[0:6], line[6:])
+
+    def send_packet(self):
+        """ Send the next packet, possibly with errors. """
+        packet_number       = self.packet_number
+        self.packet_number += 1
+
+        if self.drop_rate and (self.random.random() < self.drop_rate):
+            self.packets_dropped += 1
+            return
+
+        packet = make_packet(self.layout,
+                             packet_number,
+                             marker = int(packet_number % 50 == 0),
+                             rr     = 800 + (packet_number % 7) * 10,
+                             flag   = FLAG_BATTERY_H)
+
+        if self.bit_error_rate:
+            packet = bytearray(packet)
+            for i in range(len(packet)):
+                if self.random.random() < self.bit_error_rate:
+                    packet[i] ^= 1 << self.random.randrange(8)
+                    self.bit_errors += 1
+
+        if self.burst_rate and (self.random.random() < self.burst_rate):
+            self.bursts += 1
+            self.sock.sendall(bytes(self.random.getrandbits(8) for i in range(self.burst_length)))
+
+        self.sock.sendall(packet)
+        self.packets_sent += 1
+
+    def run(self):
+        self.running   = True
+        self.next_time = time.time()
+        buf            = b''
+
+        try:
+            while self.running:
+                if self.online:
+                    if self.speed > 0:
+                        timeout = max(0.0, self.next_time - time.time())
+                    else:
+                        timeout = 0.0
+                else:
+                    timeout = 0.5
+
+                readable, w, x = select.select([self.sock], [], [], timeout)
+                if readable:
+                    data = self.sock.recv(1024)
+                    if not data:
+                        break
+                    buf = self.parse_commands(buf + data)
+
+                if self.online and ((self.speed <= 0) or (time.time() >= self.next_time)):
+                    if (self.max_packets is not None) and (self.packets_sent + self.packets_dropped >= self.max_packets):
+                        self.online = False
+                        continue
+                    self.send_packet()
+                    if self.speed > 0:
+                        self.next_time += PACKET_DURATION / self.speed
+        except OSError:
+            pass
+        finally:
+            self.running = False
+            self.sock.close()
+
+    def stop(self):
+        self.running = False
+
+
+def simulator_socketpair(**kwargs):
+    """ Start a FarosSimulator on one end of a socket pair and return
+        the other end and the simulator. The keyword arguments are
+        passed to FarosSimulator.
+    """
+    s1, s2    = socket.socketpair()
+    simulator = FarosSimulator(s2, **kwargs)
+    simulator.start()
+    return s1, simulator
+
+
+def serve_tcp(host = '127.0.0.1', port = 5000, **kwargs):
+    """ Run simulated devices on a TCP port, one for each connection.
+        The keyword arguments are passed to FarosSimulator.
+    """
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((host, port))
+    server.listen(8)
+    print("Simulated Faros device listening on {0}:{1}".format(host, port))
+
+    try:
+        while True:
+            conn, addr = server.accept()
+            print("Connection from {0}:{1}".format(addr[0], addr[1]))
+            FarosSimulator(conn, **kwargs).start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+
+def simulator_cli():
+    parser = argparse.ArgumentParser(description = "Simulated Faros device")
+    parser.add_argument("--host", dest = "host", help="Address to listen on. Default is 127.0.0.1.", default = "127.0.0.1")
+    parser.add_argument("--port", dest = "port", type = int, help="TCP port to listen on. Default is 5000.", default = 5000)
+    parser.add_argument("--settings", dest = "settings", help="Device settings as an 8-character string (see faros --show-settings). Default is 11101101.", default = "11101101")
+    parser.add_argument("--name", dest = "name", help="Device name. Default is AATOS-0001.", default = "AATOS-0001")
+    parser.add_argument("--speed", dest = "speed", type = float, help="1 = real time, 2 = twice as fast, 0 = as fast as possible. Default is 1.", default = 1.0)
+    parser.add_argument("--bit-error-rate", dest = "bit_error_rate", type = float, help="Probability of a bit error per byte. Default is 0.", default = 0.0)
+    parser.add_argument("--drop-rate", dest = "drop_rate", type = float, help="Probability of dropping a packet. Default is 0.", default = 0.0)
+    parser.add_argument("--burst-rate", dest = "burst_rate", type = float, help="Probability of sending a burst of random bytes before a packet. Default is 0.", default = 0.0)
+    parser.add_argument("--seed", dest = "seed", type = int, help="Seed for the random errors.", default = None)
+
+    args = parser.parse_args()
+
+    serve_tcp(args.host, args.port,
+              settings       = args.settings,
+              name           = args.name,
+              speed          = args.speed,
+              bit_error_rate = args.bit_error_rate,
+              drop_rate      = args.drop_rate,
+              burst_rate     = args.burst_rate,
+              seed           = args.seed)
+
+
+if __name__ == '__main__':
+    simulator_cli()
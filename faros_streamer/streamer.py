@@ -12,23 +12,282 @@
 # Please see the file LICENSE for details.
 
 import sys
+import os
 import argparse
 import time
 from .libfaros import *
 from .utilities import *
+from .recording import CaptureWriter, CaptureReader
+from .replay import ReplayThread
+from .profiling import Profiler, print_profile
+from .devices import DeviceCache, CACHE_TTL
+from .fleet import fleet_cli
+from .clock import calibrate_devices, estimate_drift, write_clock_file, CALIBRATION_TIME
   
+def create_streamer(faros_socket, args, add_device_name = False, properties = None, profiler = None, offline = False, device_mac = None):
+    """ Create the LSL outlets for the device connected to
+        faros_socket and a StreamerThread streaming its data.
+        If add_device_name is True, the name of the device is added
+        to the stream name prefix. If properties (see get_properties)
+        are given, they are not read from the device. If profiler is
+        given, the streaming is profiled. offline tells that the device
+        is not streaming (see StreamerThread). If device_mac is given
+        and args.reconnect is set, the device is reconnected if the
+        connection is lost.
+    """
+    ## get the settings
+    if properties is None:
+        properties = get_properties(faros_socket)
+    settings    = unpack_settings(properties['settings'])
+    layout      = PacketLayout(settings)
+
+    # Create LSL outlets
+    prefix = args.stream_prefix
+    if add_device_name:
+        if prefix != '':
+            prefix += '_'
+        prefix += properties['name']
+
+    if prefix != '':
+        prefix += '_'
+
+    if args.fill_gaps == 'nan':
+        data_format = 'float32'
+    else:
+        data_format = 'int16'
+
+    if args.packets_per_push is not None:
+        packets_per_push = max(1, args.packets_per_push)
+    elif args.push_interval_ms is not None:
+        packets_per_push = max(1, int(round(args.push_interval_ms / (1000 * PACKET_DURATION))))
+    else:
+        packets_per_push = 1
+    
+    # (1) ----- ECG -----
+    if layout.n_ecg_s > 0:
+        sn               = prefix + 'faros_ecg'
+        faros_outlet_ecg = create_lsl_outlet(sn, 'ECG', layout.n_ecg_c, settings['ecg_fs'], channel_format = data_format, max_buffered = args.max_buffered, chunk_size = args.chunk_size)
+    else:
+        faros_outlet_ecg = None
+        
+    # (2) ----- Acc -----
+    if layout.n_acc_s > 0:
+        sn               = prefix + 'faros_acc'
+        faros_outlet_acc = create_lsl_outlet(sn, 'Acc', 3, settings['acc_fs'], channel_format = data_format, max_buffered = args.max_buffered, chunk_size = args.chunk_size)
+    else:
+        faros_outlet_acc = None
+
+    # (3) ----- Marker -----
+    sn                  = prefix + 'faros_marker'
+    faros_outlet_marker = create_lsl_outlet(sn, "Marker", 1, 0.0, channel_format = 'int16', max_buffered = args.max_buffered, chunk_size = args.chunk_size)
+ 
+    # (4) ----- RR -----
+    if layout.n_rr_s > 0:
+        sn                = prefix + 'faros_rr'
+        faros_outlet_rr   = create_lsl_outlet(sn, "RR", 1, 0.0, channel_format = 'int16', max_buffered = args.max_buffered, chunk_size = args.chunk_size)
+    else:
+        faros_outlet_rr   = None
+        
+    # (5) ----- Temperature -----
+    if layout.n_temp_s > 0:
+        sn                = prefix + 'faros_temp'
+        faros_outlet_temp = create_lsl_outlet(sn, "Temp", 1, 5, channel_format = 'float32', max_buffered = args.max_buffered, chunk_size = args.chunk_size)
+    else:
+        faros_outlet_temp = None
+
+    # Record the raw data
+    if args.record is not None:
+        path = args.record
+        if add_device_name:
+            root, ext = os.path.splitext(path)
+            path      = root + '_' + properties['name'] + ext
+        recorder = CaptureWriter(path, properties, layout)
+        print("Recording raw data to " + path)
+    else:
+        recorder = None
+
+    # Status stream
+    if args.metrics_lsl:
+        sn            = prefix + 'faros_status'
+        status_outlet = create_lsl_outlet(sn, 'Status', len(STATUS_CHANNELS), 1.0 / args.metrics_interval, channel_format = 'float32', max_buffered = args.max_buffered)
+    else:
+        status_outlet = None
+
+    # Reconnect if the connection is lost
+    if args.reconnect and (device_mac is not None):
+        def reconnect():
+            # only stop the device and check that its settings are unchanged
+            s = open_transport(device_mac)
+            try:
+                res, settings = send_commands(s, [['wbaoms', 7, True],
+                                                  PROPERTY_COMMANDS['settings']])
+                if settings != properties['settings']:
+                    raise ValueError("the device settings have changed")
+            except:
+                s.close()
+                raise
+            return s
+    else:
+        reconnect = None
+
+    streamer_thread = StreamerThread(stream_data   = False,
+                                     faros_socket  = faros_socket,
+                                     layout        = layout,
+
+                                     outlet_ecg    = faros_outlet_ecg,
+                                     outlet_acc    = faros_outlet_acc,
+                                     outlet_marker = faros_outlet_marker,
+                                     outlet_rr     = faros_outlet_rr,
+                                     outlet_temp   = faros_outlet_temp,
+
+                                     fill_gaps        = args.fill_gaps,
+                                     packets_per_push = packets_per_push,
+                                     queue_size       = args.queue_size,
+                                     queue_policy     = args.queue_policy,
+                                     device_name      = properties['name'],
+                                     recorder         = recorder,
+                                     status_outlet    = status_outlet,
+                                     profiler         = profiler,
+                                     offline          = offline,
+                                     reconnect        = reconnect,
+                                     stall_timeout    = args.stall_timeout,
+                                     max_backoff      = args.max_backoff)
+
+    return(streamer_thread)
+
+
+def start_metrics(streamers, args):
+    """ Start serving the metrics of the streamers over HTTP and LSL,
+        as requested by args. Returns the started threads.
+    """
+    threads = []
+    if args.metrics_port is not None:
+        server = MetricsServer(streamers, args.metrics_port, args.metrics_host)
+        server.start()
+        threads.append(server)
+        print("Serving metrics at http://{0}:{1}/metrics".format(args.metrics_host, args.metrics_port))
+
+    if args.metrics_lsl:
+        status = StatusThread(streamers, args.metrics_interval)
+        status.start()
+        threads.append(status)
+
+    return(threads)
+
+
+def get_profiler(args):
+    """ Return a Profiler if profiling was requested, otherwise None. """
+    if args.profile or (args.profile_output is not None):
+        return Profiler()
+    return None
+
+
+def report_profile(profiler, args):
+    """ Print the profile and write the folded stacks if requested. """
+    if profiler is None:
+        return
+    print_profile(profiler)
+    if args.profile_output is not None:
+        profiler.write_folded(args.profile_output)
+        print("Profile written to " + args.profile_output)
+
+
+def write_clock_files(streamers, properties, calibrations):
+    """ Save the clock calibrations of the devices with their recordings. """
+    for streamer, p, c in zip(streamers, properties, calibrations):
+        recorder = streamer.decoder.recorder
+        if (recorder is not None) and c:
+            write_clock_file(recorder.path, p, c, streamer.clock.get_drift())
+
+
+def finish_clock_calibration(streamer_thread, streamers, properties, calibrations, args):
+    """ Calibrate the device clocks again after streaming has stopped,
+        print the drift of each clock and save the calibrations.
+    """
+    # the device time cannot be asked while the stream is being read
+    streamer_thread.join(2.0)
+    if streamer_thread.is_alive():
+        print("Devices still streaming, clocks not calibrated.")
+        return
+
+    sockets = [streamer.faros_socket for streamer in streamers]
+    for s in sockets:
+        try:
+            get_device(s).flush()
+        except OSError:
+            pass
+
+    names = [p['name'] for p in properties]
+    for c, new in zip(calibrations, calibrate_devices(sockets, names, args.calibration_time)):
+        if new is not None:
+            c.append(new)
+
+    for name, c in zip(names, calibrations):
+        drift, error = estimate_drift(c)
+        if drift is not None:
+            print_kv("Clock drift of " + name + " (ppm)", "{0:.1f} +/- {1:.1f}".format(drift, error), pad = 35)
+    print("")
+
+    write_clock_files(streamers, properties, calibrations)
+
+
+def replay_capture(args):
+    """ Stream the data in a capture file to LSL. """
+    reader   = CaptureReader(args.replay)
+    profiler = get_profiler(args)
+    streamer = create_streamer(None, args, properties = reader.header, profiler = profiler)
+
+    if (len(reader) > 0) and np.isfinite(reader.index['arrival_time'][0]):
+        start = reader.find_time(reader.index['arrival_time'][0] + args.seek)
+    else:
+        # without arrival times, the packets are taken to be consecutive
+        start = min(int(args.seek / PACKET_DURATION), len(reader))
+
+    print("Replaying {0} packets from {1}.".format(len(reader) - start, args.replay))
+
+    replay_thread = ReplayThread(streamer, reader, speed = args.replay_speed, start = start)
+    replay_thread.start()
+    metrics       = start_metrics([streamer], args)
+
+    try:
+        while replay_thread.is_alive():
+            replay_thread.join(0.5)
+        print("\nReplay finished.\n")
+    except KeyboardInterrupt:
+        print("\nReplay stopped.\n")
+
+    replay_thread.stop()
+    for thread in metrics:
+        thread.stop()
+    print_statistics(streamer.get_statistics())
+    report_profile(profiler, args)
+    reader.close()
+
+
 def faros_cli():
+    # faros fleet MANIFEST
+    if (len(sys.argv) > 1) and (sys.argv[1] == 'fleet'):
+        sys.exit(0 if fleet_cli(sys.argv[2:]) else 1)
+
     parser = argparse.ArgumentParser(description = "Faros Streamer")
     parser.add_argument("--scan", action = "store_true", help="Scan for available Bluetooth devices.")
     parser.add_argument("--blink", action = "store_true", dest = "blink_device", help="Blink the lights of a device.")
     
     parser.add_argument("--device-list", dest = "device_list", help="File containing the names and bluetooth addresses of devices. Create using --scan and pipe the output to a file.")
-    parser.add_argument("--mac", dest = "device_mac", help="Bluetooth MAC address.")
-    parser.add_argument("--name", dest = "device_name", help="Bluetooth device name.")
+    parser.add_argument("--mac", dest = "device_mac", action = "append", help="Bluetooth MAC address. Can be given several times to use several devices.")
+    parser.add_argument("--name", dest = "device_name", action = "append", help="Bluetooth device name. Can be given several times to use several devices.")
+    parser.add_argument("--uri", dest = "device_uri", action = "append", help="Connect to a device through a transport: rfcomm://MAC, tcp://HOST:PORT, serial:///dev/PORT or file://CAPTURE (see README). Can be given several times to use several devices.")
+    parser.add_argument("--stream-all", action = "store_true", dest = "stream_all", help="Use all devices in the device list (or found by --scan).")
+    parser.add_argument("--lookup-timeout", dest = "lookup_timeout", type = float, help="Time to wait for the name of each device when scanning, in seconds. Default is 10.", default = 10)
+    parser.add_argument("--cache", dest = "cache", help="Device cache file used for finding devices by name without scanning. Default is ~/.cache/faros-streamer/devices.json.", default = None)
+    parser.add_argument("--cache-ttl", dest = "cache_ttl", type = float, help="Ignore cached devices not found by a scan within this many seconds. Default is one week.", default = CACHE_TTL)
+    parser.add_argument("--no-cache", action = "store_true", dest = "no_cache", help="Do not use the device cache.")
 
 
     parser.add_argument("--show-settings", action = "store_true", dest = "show_settings", help="Get the settings of a device")
     parser.add_argument("--sync-time", action = "store_true", dest = "sync_time", help="Synchronise device time.")
+    parser.add_argument("--clock-calibration", action = "store_true", dest = "clock_calibration", help="Measure the offset of the device clock from the computer clock (before and after streaming, saved with --record).")
+    parser.add_argument("--calibration-time", dest = "calibration_time", type = float, help="Time used for measuring the offset of each device clock in seconds. Default is 3.", default = CALIBRATION_TIME)
 
     parser.add_argument("--configure", action = "store_true", help="Configure the device.")
     parser.add_argument("--ecg-n", dest = "ecg_n", help="Number of ECG channels (1 or 3).", default = 1)
@@ -44,161 +303,170 @@ def faros_cli():
 
 
     parser.add_argument("--stream", action = "store_true", dest = "stream", help="Start streaming data.")
+    parser.add_argument("--replay", dest = "replay", help="Stream the data in a capture file (see --record) instead of a device.", default = None)
+    parser.add_argument("--replay-speed", dest = "replay_speed", type = float, help="Replay speed: 1 = real time, 2 = twice as fast, 0 = as fast as possible. Default is 1.", default = 1.0)
+    parser.add_argument("--seek", dest = "seek", type = float, help="Start the replay this many seconds from the beginning of the capture. Default is 0.", default = 0.0)
 
-    parser.add_argument("--stream-prefix", dest = "stream_prefix",  help="LSL stream name prefix. Default is empty string.", default = "")
+    parser.add_argument("--stream-prefix", dest = "stream_prefix",  help="LSL stream name prefix. Default is empty string. With several devices, the device name is added to the prefix.", default = "")
+    parser.add_argument("--packets-per-push", dest = "packets_per_push", type = int, help="Number of packets (0.2 s each) of ECG and Acc data to collect before pushing them to LSL. Default is 1.", default = None)
+    parser.add_argument("--push-interval-ms", dest = "push_interval_ms", type = int, help="Push ECG and Acc data to LSL at this interval in milliseconds (rounded to whole packets of 200 ms). Alternative to --packets-per-push.", default = None)
+    parser.add_argument("--max-buffered", dest = "max_buffered", type = int, help="Maximum amount of data (in seconds) buffered by the LSL outlets for each consumer. Default is 1.", default = 1)
+    parser.add_argument("--chunk-size", dest = "chunk_size", type = int, help="Preferred LSL chunk size in samples (0 = chunks as pushed). Default is 0.", default = 0)
+    parser.add_argument("--queue-size", dest = "queue_size", type = int, help="Size of the queues between the reading, decoding and LSL threads. Default is 64.", default = 64)
+    parser.add_argument("--queue-policy", dest = "queue_policy", choices = QUEUE_POLICIES, help="What to do when a queue is full: block, drop-oldest or drop (the new data). Default is block.", default = "block")
+    parser.add_argument("--record", dest = "record", help="Write the raw data received from the device into this capture file (with an index in PATH.idx). With several devices, the device name is added to the file name.", default = None)
+    parser.add_argument("--fill-gaps", dest = "fill_gaps", choices = ["none", "zero", "nan"], help="Replace the ECG and Acc samples of lost packets with zeros or NaNs (nan makes the ECG and Acc streams float32). Default is none.", default = "none")
+    parser.add_argument("--metrics-port", dest = "metrics_port", type = int, help="Serve streaming metrics in the Prometheus text format at http://HOST:PORT/metrics. Default is off.", default = None)
+    parser.add_argument("--metrics-host", dest = "metrics_host", help="Address for serving the metrics. Default is 127.0.0.1.", default = "127.0.0.1")
+    parser.add_argument("--metrics-lsl", action = "store_true", dest = "metrics_lsl", help="Also send the streaming status as an LSL stream (faros_status).")
+    parser.add_argument("--metrics-interval", dest = "metrics_interval", type = float, help="Interval of the LSL status stream in seconds. Default is 1.", default = 1.0)
+    parser.add_argument("--reconnect", action = "store_true", dest = "reconnect", help="Reconnect to a device if the connection is lost, keeping the LSL streams.")
+    parser.add_argument("--stall-timeout", dest = "stall_timeout", type = float, help="With --reconnect, consider the connection lost if no data arrives for this many seconds. Default is 5.", default = 5.0)
+    parser.add_argument("--max-backoff", dest = "max_backoff", type = float, help="With --reconnect, the longest time between reconnection attempts in seconds. Default is 30.", default = 30.0)
+    parser.add_argument("--profile", action = "store_true", dest = "profile", help="Measure the time spent in each stage of the streaming and print it when streaming stops.")
+    parser.add_argument("--profile-output", dest = "profile_output", help="Write the profile (CPU time per stage) to this file in the folded format of flamegraph.pl. Implies --profile.", default = None)
 
     # --------------------------------------------------
     
     args = parser.parse_args()
 
+    # Replay a capture file
+    if args.replay is not None:
+        replay_capture(args)
+        sys.exit(0)
+
+    # Devices found by earlier scans
+    if args.no_cache:
+        cache = None
+    else:
+        cache = DeviceCache(args.cache, args.cache_ttl)
+
     # Scan for bluetooth devices
+    device_list = None
     if args.scan:
-        device_list = get_devices()
+        device_list = get_devices(args.lookup_timeout)
+        if cache is not None:
+            cache.update(device_list)
 
     # Read device list if given
     if args.device_list is not None:
         device_list = read_device_list(args.device_list)
-    else:
-        device_list = None
 
-    # (1) a MAC-address was given
+    # (1) MAC-addresses were given
+    device_macs = []
     if args.device_mac is not None:
-        device_mac = args.device_mac
-        print("Using device with MAC address: " + device_mac)
-    else:
-        device_mac = None
+        for device_mac in args.device_mac:
+            print("Using device with MAC address: " + device_mac)
+            device_macs.append(device_mac)
+
+    if args.device_uri is not None:
+        for device_uri in args.device_uri:
+            print("Using device at: " + device_uri)
+            device_macs.append(device_uri)
+
+    # (2) Names were given
+    if (device_list is None) and (args.device_name is not None) and (cache is not None):
+        cached = cache.get_devices()
+        if all(device_name in cached for device_name in args.device_name):
+            print("Using cached device list ({0}).\n".format(cache.path))
+            device_list = cached
+
+    if (args.device_name is not None) or args.stream_all:
+        if device_list is None:
+            print("No device list provided, must scan for devices first.\n")
+            device_list = get_devices(args.lookup_timeout)
+            if cache is not None:
+                cache.update(device_list)
 
-    # (2) A name was given
     if args.device_name is not None:
-        device_name = args.device_name
-        try:
-            if device_list is None:
-                print("No device list provided, must scan for devices first.\n")
-                device_list = get_devices()
-            device_mac = device_list[device_name]
-        except KeyError:
-            device_mac = None
-            print_error("Device not found in list.")
-            sys.exit(1)
-    else:
-        device_name = None
-            
+        for device_name in args.device_name:
+            try:
+                device_macs.append(device_list[device_name])
+            except KeyError:
+                print_error("Device not found in list: " + device_name)
+                sys.exit(1)
 
-    if (device_mac is None) and (device_name is None):
-        print("No name or MAC address given. Cannot continue.\n")
+    # (3) All devices in the list
+    if args.stream_all:
+        for device_name in device_list:
+            if device_list[device_name] not in device_macs:
+                device_macs.append(device_list[device_name])
+
+    if len(device_macs) == 0:
+        print("No name, MAC address or URI given. Cannot continue.\n")
         print("Type faros_streamer --help to display usage information.\n")
         sys.exit(1)
     
-    # Try to connect to the given device
-    try:
-        faros_socket = connect(device_mac)
-        command = "wbaoms"
-        res     = send_command(faros_socket, command, 7)
-        print("Connection established.\n")
-    except:
-        faros_socket = None
-        print("Unable to connect to device ({0}).".format(sys.exc_info()[0]))
-        sys.exit(1)
+    # Try to connect to the given devices
+    faros_sockets = []
+    properties    = []
+    for device_mac in device_macs:
+        try:
+            faros_socket, p = open_device(device_mac, cache)
+            faros_sockets.append(faros_socket)
+            properties.append(p)
+            print("Connection established ({0}).\n".format(device_mac))
+        except:
+            print("Unable to connect to device {0} ({1}).".format(device_mac, sys.exc_info()[0]))
+            sys.exit(1)
 
-    # Set different parameters of the Faros device
-    if args.configure:
-        settings = mode_to_str(args.ecg_n,
-                               args.ecg_fs,
-                               args.ecg_res,
-                               args.ecg_hp,
-                               args.rr,
-                               args.acc_fs,
-                               args.acc_res,
-                               args.temp)
-
-        configure_device(faros_socket, settings)
-
-    # Show device settings    
-    if args.show_settings:
-        properties = get_properties(faros_socket)
-        print_properties(properties)
+    for i, faros_socket in enumerate(faros_sockets):
+        # Set different parameters of the Faros device
+        if args.configure:
+            settings = mode_to_str(args.ecg_n,
+                                   args.ecg_fs,
+                                   args.ecg_res,
+                                   args.ecg_hp,
+                                   args.rr,
+                                   args.acc_fs,
+                                   args.acc_res,
+                                   args.temp)
 
-    # Synchronise the device time
-    if args.sync_time:
-        sync_time(faros_socket)
-        
-    # Should the device blink
-    if args.blink_device:
-        blink_device(faros_socket)
+            configure_device(faros_socket, settings)
+
+            # the properties changed
+            properties[i] = get_properties(faros_socket)
+            if (cache is not None) and (get_transport_mac(device_macs[i]) is not None):
+                cache.set_properties(get_transport_mac(device_macs[i]), properties[i])
+
+        # Show device settings    
+        if args.show_settings:
+            print_properties(get_properties(faros_socket))
+
+        # Synchronise the device time
+        if args.sync_time:
+            sync_time(faros_socket)
+
+        # Should the device blink
+        if args.blink_device:
+            blink_device(faros_socket)
+
+    # Measure the offsets of the device clocks
+    calibrations = [[] for faros_socket in faros_sockets]
+    if args.clock_calibration:
+        names = [p['name'] for p in properties]
+        for c, new in zip(calibrations, calibrate_devices(faros_sockets, names, args.calibration_time)):
+            if new is not None:
+                c.append(new)
 
     # Start streaming data
     if args.stream:
-        ## get the settings
-        properties  = get_properties(faros_socket)
-        settings    = unpack_settings(properties['settings'])
-        packet_size = get_packet_size(settings)
-        
-        # Get packet formats and create LSL outlets
-        p_header = get_packet_header()
+        profiler  = get_profiler(args)
+        streamers = []
+        for faros_socket, p, device_mac in zip(faros_sockets, properties, device_macs):
+            streamers.append(create_streamer(faros_socket, args, add_device_name = (len(faros_sockets) > 1), properties = p, profiler = profiler, offline = True, device_mac = device_mac))
 
-        if args.stream_prefix != '':
-            args.stream_prefix += '_'
-        
-        # (1) ----- ECG -----
-        if packet_size['n_ecg_s'] > 0:
-            p_ecg            = get_data_packet((packet_size['n_ecg_c'] * packet_size['n_ecg_s']), 'ecg')
-            sn               = args.stream_prefix + 'faros_ecg'
-            faros_outlet_ecg = create_lsl_outlet(sn, 'ECG', packet_size['n_ecg_c'], settings['ecg_fs'], channel_format = 'int16')
-        else:
-            p_ecg            = None
-            faros_outlet_ecg = None
-            
-        # (2) ----- Acc -----
-        if packet_size['n_acc_s'] > 0:
-            p_acc            = get_data_packet(3 * packet_size['n_acc_s'], 'acc')
-            sn               = args.stream_prefix + 'faros_acc'
-            faros_outlet_acc = create_lsl_outlet(sn, 'Acc', 3, settings['acc_fs'], channel_format = 'int16')
+        if len(streamers) == 1:
+            streamer_thread = streamers[0]
         else:
-            p_acc            = None
-            faros_outlet_acc = None
+            # read all devices in one thread
+            streamer_thread = MultiStreamerThread(streamers)
 
-        # (3) ----- Marker -----
-        p_marker            = get_data_packet(1, 'marker')
-        sn                  = args.stream_prefix + 'faros_marker'
-        faros_outlet_marker = create_lsl_outlet(sn, "Marker", 1, 0.0, channel_format = 'int16')
- 
-        # (4) ----- RR -----
-        if packet_size['n_rr_s'] > 0:
-            p_rr              = get_data_packet(1, 'rr')
-            sn                = args.stream_prefix + 'faros_rr'
-            faros_outlet_rr   = create_lsl_outlet(sn, "RR", 1, 0.0, channel_format = 'int16')
-        else:
-            p_rr              = None
-            faros_outlet_rr   = None
-            
-        # (5) ----- Temperature -----
-        if packet_size['n_temp_s'] > 0:
-            p_temp            = get_data_packet(1, 'temp')
-            sn                = args.stream_prefix + 'faros_temp'
-            faros_outlet_temp = create_lsl_outlet(sn, "Temp", 1, 5, channel_format = 'float32')
-        else:
-            p_temp            = None
-            faros_outlet_temp = None
-
-        streamer_thread = StreamerThread(stream_data   = False,
-                                         faros_socket  = faros_socket,
-                                         packet_size   = packet_size,
-
-                                         p_header      = p_header,
-                                         p_ecg         = p_ecg,
-                                         p_acc         = p_acc,
-                                         p_marker      = p_marker,
-                                         p_rr          = p_rr,
-                                         p_temp        = p_temp,
-
-                                         outlet_ecg    = faros_outlet_ecg,
-                                         outlet_acc    = faros_outlet_acc,
-                                         outlet_marker = faros_outlet_marker,
-                                         outlet_rr     = faros_outlet_rr,
-                                         outlet_temp   = faros_outlet_temp)
+        write_clock_files(streamers, properties, calibrations)
 
         # Start the streaming and show a UI
         streamer_thread.start()
+        start_metrics(streamers, args)
 
         while True:
             try:
@@ -207,10 +475,18 @@ def faros_cli():
                 if tmp == "q":
                     streamer_thread.stop()
                     print("\nStreaming stopped.\n")
+                    for streamer in streamers:
+                        print_statistics(streamer.get_statistics())
+                    if args.clock_calibration:
+                        finish_clock_calibration(streamer_thread, streamers, properties, calibrations, args)
+                    report_profile(profiler, args)
                     sys.exit(0)
             except KeyboardInterrupt:
-                command = "wbaoms"
-                send_command(faros_socket, command, 0)
+                streamer_thread.stop()
+                print("\nStreaming stopped.\n")
+                for streamer in streamers:
+                    print_statistics(streamer.get_statistics())
+                report_profile(profiler, args)
                 sys.exit(0)
                 
 if __name__ == '__main__':
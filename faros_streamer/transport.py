@@ -0,0 +1,238 @@
+# This file is part of Faros Streamer.
+#
+# Copyright 2015
+# Andreas Henelius <andreas.henelius@ttl.fi>,
+# Finnish Institute of Occupational Health
+#
+# This code is released under the MIT License
+# http://opensource.org/licenses/mit-license.php
+#
+# Please see the file LICENSE for details.
+
+from .libfaros import *
+from .recording import CaptureReader, CAPTURE_MAGIC
+from .simulator import FarosSimulator
+from urllib.parse import urlsplit, parse_qs
+import mmap
+import re
+import socket
+
+# -------------------------------------------------------------------------------
+# Transports
+#
+# A transport is the connection to a device. Every transport behaves
+# like a socket: it has recv_into (used for streaming without copying),
+# recv, send, sendall, settimeout, gettimeout, setblocking, fileno (so
+# that several devices can be read from one thread) and close. A
+# transport is opened with a URI:
+#
+#   rfcomm://AA:BB:CC:11:22:33[?channel=1]  Bluetooth (the default; a bare
+#                                           address means the same)
+#   tcp://host:port                         e.g., a Bluetooth gateway near
+#                                           the subject or faros-simulator
+#   serial:///dev/rfcomm0[?baudrate=115200] serial port (requires pyserial)
+#   file://capture.bin[?speed=1&settings=11101101&name=AATOS-0001]
+#                                           a capture file (see --record)
+#                                           or a file of raw packets,
+#                                           replayed as a device
+# -------------------------------------------------------------------------------
+
+TRANSPORT_SCHEMES = ['rfcomm', 'tcp', 'serial', 'file']
+
+
+def is_mac_address(x):
+    return re.match(r'^(?:[0-9A-Fa-f]{2}:){5}[0-9A-Fa-f]{2}$', x) is not None
+
+
+def get_query(parts):
+    """ Return the query parameters of a URI as a dictionary. """
+    return {k : v[-1] for k, v in parse_qs(parts.query).items()}
+
+
+def get_transport_mac(uri):
+    """ Return the bluetooth address of a Bluetooth URI (or a bare
+        address), or None for other transports.
+    """
+    if is_mac_address(uri):
+        return uri.upper()
+    if uri.startswith('rfcomm://'):
+        return urlsplit(uri).netloc.upper()
+    return None
+
+
+def open_transport(uri, timeout = 10.0):
+    """ Open the transport given by uri (see above). timeout is the
+        time to wait for the connection, in seconds. The transport is
+        returned in blocking mode.
+    """
+    if is_mac_address(uri):
+        uri = 'rfcomm://' + uri
+
+    parts = urlsplit(uri)
+    query = get_query(parts)
+
+    if parts.scheme == 'rfcomm':
+        import bluetooth
+        s = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
+        s.connect((parts.netloc, int(query.get('channel', 1))))
+        return s
+
+    if parts.scheme == 'tcp':
+        if (parts.hostname is None) or (parts.port is None):
+            raise ValueError("A TCP transport needs a host and a port: " + uri)
+        s = socket.create_connection((parts.hostname, parts.port), timeout)
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        s.settimeout(None)
+        return s
+
+    if parts.scheme == 'serial':
+        return SerialTransport(parts.path, int(query.get('baudrate', 115200)))
+
+    if parts.scheme == 'file':
+        return open_file_transport(parts.netloc + parts.path,
+                                   settings = query.get('settings'),
+                                   name     = query.get('name'),
+                                   speed    = float(query.get('speed', 1.0)))
+
+    raise ValueError("Unknown transport: {0} (use one of {1})".format(uri, ', '.join(TRANSPORT_SCHEMES)))
+
+
+# -------------------------------------------------------------------------------
+# Serial ports
+# -------------------------------------------------------------------------------
+
+class SerialTransport(object):
+    """ A serial port (e.g., /dev/rfcomm0 bound with rfcomm bind, or a
+        serial-to-Bluetooth bridge) used like a socket.
+
+        As with sockets, recv_into waits for at least one byte and
+        returns what is available, and socket.timeout is raised if
+        nothing arrives within the timeout.
+    """
+    def __init__(self, path, baudrate = 115200):
+        try:
+            import serial
+        except ImportError:
+            raise ImportError("The serial transport requires pyserial (pip install faros-streamer[serial]).")
+        self.serial  = serial.Serial(path, baudrate, timeout = None, write_timeout = None)
+        self.timeout = None
+
+    def settimeout(self, timeout):
+        self.timeout              = timeout
+        self.serial.timeout       = timeout
+        self.serial.write_timeout = timeout
+
+    def gettimeout(self):
+        return self.timeout
+
+    def setblocking(self, flag):
+        self.settimeout(None if flag else 0.0)
+
+    def fileno(self):
+        return self.serial.fileno()
+
+    def recv_into(self, buf, nbytes = 0):
+        buf = memoryview(buf).cast('B')
+        if nbytes:
+            buf = buf[0:nbytes]
+        n = self.serial.readinto(buf[0:1])
+        if not n:
+            raise socket.timeout("timed out")
+        available = min(self.serial.in_waiting, len(buf) - 1)
+        if available > 0:
+            n += self.serial.readinto(buf[1:(1 + available)])
+        return n
+
+    def recv(self, n):
+        buf = bytearray(n)
+        k   = self.recv_into(buf)
+        return bytes(buf[0:k])
+
+    def send(self, data):
+        return self.serial.write(data)
+
+    def sendall(self, data):
+        self.serial.write(data)
+        self.serial.flush()
+
+    def close(self):
+        self.serial.close()
+
+
+# -------------------------------------------------------------------------------
+# Files
+# -------------------------------------------------------------------------------
+
+class FileSimulator(FarosSimulator):
+    """ A simulated device that sends the packets of a file instead of
+        generated packets, at the pace of a real device (speed = 1.0),
+        and closes the connection at the end of the file.
+
+        The file is a capture file (see CaptureWriter), whose header
+        gives the settings and the name of the device, or a file of raw
+        packets, for which the settings must be given. The settings of
+        the device cannot be changed.
+    """
+    def __init__(self, sock, path, settings = None, name = None, speed = 1.0):
+        self.f  = open(path, 'rb')
+        self.mm = mmap.mmap(self.f.fileno(), 0, access = mmap.ACCESS_READ)
+
+        kwargs = {}
+        if self.mm[0:len(CAPTURE_MAGIC)] == CAPTURE_MAGIC:
+            reader   = CaptureReader(path)
+            header   = reader.header
+            start    = reader.data_offset
+            # the index is not needed for replaying
+            end      = start + ((len(self.mm) - start) // reader.layout.size) * reader.layout.size
+            settings = header['settings'][3:]
+            if header.get('name'):
+                kwargs['name'] = header['name']
+            if header.get('firmware-version'):
+                kwargs['firmware_version'] = header['firmware-version']
+            if header.get('firmware-build'):
+                kwargs['firmware_build'] = header['firmware-build']
+            reader.close()
+        else:
+            if settings is None:
+                raise ValueError("The settings of the raw packets in {0} must be given (e.g., file://{0}?settings=11101101).".format(path))
+            start = 0
+            end   = len(self.mm)
+
+        if name is not None:
+            kwargs['name'] = name
+
+        FarosSimulator.__init__(self, sock, settings = settings, speed = speed, **kwargs)
+        self.start_offset = start
+        self.end_offset   = end
+        self.position     = start
+
+    def handle_command(self, command, argument):
+        if (command == b'wbasds') and (argument.decode('ascii', 'replace') != self.settings):
+            self.respond(b'wbanak\r')
+        else:
+            FarosSimulator.handle_command(self, command, argument)
+
+    def send_packet(self):
+        if self.position >= self.end_offset:
+            # closing the connection ends the stream
+            self.running = False
+            return
+        b2 = min(self.position + self.layout.size, self.end_offset)
+        self.sock.sendall(self.mm[self.position:b2])
+        self.position      = b2
+        self.packets_sent += 1
+
+    def run(self):
+        try:
+            FarosSimulator.run(self)
+        finally:
+            self.mm.close()
+            self.f.close()
+
+
+def open_file_transport(path, settings = None, name = None, speed = 1.0):
+    """ Return a socket connected to a FileSimulator replaying path. """
+    s1, s2    = socket.socketpair()
+    simulator = FileSimulator(s2, path, settings, name, speed)
+    simulator.start()
+    return s1
@@ -11,23 +11,27 @@
 
 from .libfaros import *
 import hashlib
-from pylsl import StreamInfo, StreamOutlet
+from pylsl import StreamInfo, StreamOutlet, local_clock
+from .pipeline import *
+from .metrics import *
+from .transport import open_transport, get_transport_mac
 import threading
+import selectors
+import socket
 import time
-import crc16
 import sys
+import re
 
 def read_device_list(f):
-    """ Read a device from a previous bluetooth scan. """
+    """ Read a device list from a previous bluetooth scan (the output
+        of faros --scan). Lines without a name and a bluetooth address
+        are ignored.
+    """
     device_list = {}
-    data = open(f).readlines()
-
-    del(data[0:2])
-    del(data[-1])
-
-    for line in data:
-        line = line.split("\t")
-        device_list[line[0]] = line[1].strip()
+    for line in open(f):
+        m = re.match(r'^(.+?)\s+((?:[0-9A-Fa-f]{2}:){5}[0-9A-Fa-f]{2})\s*$', line)
+        if m is not None:
+            device_list[m.group(1).strip()] = m.group(2).upper()
 
     print("-" * 35)
     print("Using the following device list:")
@@ -38,21 +42,60 @@ def read_device_list(f):
     return(device_list)
 
 
+def open_device(device_mac, cache = None):
+    """ Connect to the device with bluetooth address device_mac (or
+        another transport URI, see open_transport) and stop any
+        streaming. Returns the transport and the properties of the
+        device (see get_properties, without the device time).
+
+        If cache (a DeviceCache) holds the properties of the device
+        and the settings of the device have not changed, the cached
+        properties are used. Otherwise they are read from the device
+        and stored in the cache. Only Bluetooth devices are cached.
+    """
+    s = open_transport(device_mac)
+    res, settings = send_commands(s, [['wbaoms', 7, True],
+                                      PROPERTY_COMMANDS['settings']])
+
+    mac = get_transport_mac(device_mac)
+    if mac is None:
+        cache = None
+
+    properties = None
+    if cache is not None:
+        properties = cache.get_properties(mac)
+        if (properties is not None) and (properties['settings'] != settings):
+            properties = None
+
+    if properties is None:
+        properties = get_properties(s)
+        if cache is not None:
+            cache.set_properties(mac, properties)
+    else:
+        properties = dict(properties)
+
+    return s, properties
+
+
 def blink_device(socket):
     """ Blink the LEDs of a Faros device. """
     command = "wbaled"
     send_command(socket, command)
 
     
-def configure_device(socket, settings):
-    """ Configure a Faros device by sending all settings as one string. """
+def configure_device(socket, settings, verbose = True):
+    """ Configure a Faros device by sending all settings as one string.
+        Returns True if the device accepted the settings.
+    """
     ## example : settings = '32100t00'
     command = 'wbasds' + settings
     res = send_command(socket, command, r_length = 7)
-    if res == 'wbaack':
-        print("Settings successfully stored.")
-    else:
-        print("Error! Settings not stored.")
+    if verbose:
+        if res == 'wbaack':
+            print("Settings successfully stored.")
+        else:
+            print("Error! Settings not stored.")
+    return res == 'wbaack'
     
 def print_error(msg):
     """ Print an error message. """
@@ -60,8 +103,13 @@ def print_error(msg):
     print(msg)
 
     
-def create_lsl_outlet(stream_name, stream_type, channel_count, sampling_rate, channel_format = 'int16'):
-    """ Create an LSL outlet. """
+def create_lsl_outlet(stream_name, stream_type, channel_count, sampling_rate, channel_format = 'int16', max_buffered = 1, chunk_size = 0):
+    """ Create an LSL outlet.
+
+        max_buffered : how much data (in seconds) to buffer for each consumer
+        chunk_size   : preferred number of samples per chunk sent to consumers
+                       (0 = as pushed)
+    """
     stream_id = hashlib.md5(stream_name.encode("ascii")).hexdigest()[1:10]
     info      = StreamInfo(name           = stream_name,
                            type           = stream_type,
@@ -69,109 +117,685 @@ def create_lsl_outlet(stream_name, stream_type, channel_count, sampling_rate, ch
                            nominal_srate  = sampling_rate,
                            channel_format = channel_format,
                            source_id      = stream_id)
-    return StreamOutlet(info, max_buffered = 1)
+    return StreamOutlet(info, chunk_size = chunk_size, max_buffered = max_buffered)
+
+
+class PacketClock(object):
+    """ Map packet numbers to LSL time.
+
+        The device produces one packet every PACKET_DURATION seconds,
+        so the packet number is a device clock. The arrival times of
+        the packets are fitted with a linear model
+
+            arrival = offset + rate * device_time
+
+        using recursive least squares with exponential forgetting, which
+        follows the drift between the device clock and the LSL clock
+        while averaging out the jitter of the Bluetooth link.
+    """
+    def __init__(self, forgetting = 0.9999):
+        self.forgetting = forgetting
+        self.t0         = None
+        self.theta      = np.array([0.0, 1.0])
+        self.P          = np.diag([1e6, 1e-6])
+        self.last_time  = None
+        self.last_n     = None
+
+    def update(self, packet_number, arrival_time):
+        """ Add the arrival time (LSL time) of a packet to the model. """
+        t_dev = (packet_number + 1) * PACKET_DURATION
+        if self.t0 is None:
+            self.t0    = t_dev
+            self.theta = np.array([arrival_time, 1.0])
+
+        x    = np.array([1.0, t_dev - self.t0])
+        Px   = self.P.dot(x)
+        k    = Px / (self.forgetting + x.dot(Px))
+        err  = arrival_time - self.theta.dot(x)
+
+        self.theta = self.theta + k * err
+        self.P     = (self.P - np.outer(k, Px)) / self.forgetting
+
+    def packet_time(self, packet_number):
+        """ Return the LSL time at the end of a packet. Successive
+            packets always get increasing times.
+        """
+        t = self.theta[0] + self.theta[1] * ((packet_number + 1) * PACKET_DURATION - self.t0)
+
+        if self.last_time is not None:
+            step = ((packet_number - self.last_n) & 0xFFFFFFFF) * PACKET_DURATION
+            if t < self.last_time + 0.5 * step:
+                t = self.last_time + step
+
+        self.last_time = t
+        self.last_n    = packet_number
+        return t
+
+    def restart(self):
+        """ Start the model from scratch, e.g., after the device has
+            started numbering its packets from zero again.
+        """
+        self.__init__(self.forgetting)
+
+    def get_drift(self):
+        """ Return the drift of the device clock relative to the LSL
+            clock in parts per million, or None before the first packet.
+        """
+        if self.t0 is None:
+            return None
+        return float((self.theta[1] - 1.0) * 1e6)
+
+
+class PacketBatcher(object):
+    """ Collect the ECG and accelerometer samples of n_packets packets
+        into preallocated arrays and push them to LSL as one chunk.
+    """
+    def __init__(self, layout, n_packets, outlet_ecg, outlet_acc, dtype = np.int16):
+        self.layout     = layout
+        self.n_packets  = n_packets
+        self.outlet_ecg = outlet_ecg
+        self.outlet_acc = outlet_acc
+
+        self.ecg        = np.zeros((n_packets * layout.n_ecg_s, layout.n_ecg_c), dtype = dtype)
+        self.acc        = np.zeros((n_packets * layout.n_acc_s, 3), dtype = dtype)
+        self.n          = 0
+        self.timestamp  = 0.0
+
+    def add(self, data, timestamp = 0.0):
+        """ Add a decoded packet (see push_data). The samples are pushed
+            when n_packets packets have been collected.
+        """
+        if self.outlet_ecg is not None:
+            b1 = self.n * self.layout.n_ecg_s
+            self.ecg[b1:(b1 + self.layout.n_ecg_s)] = data['ecg'].T
+
+        if self.outlet_acc is not None:
+            b1 = self.n * self.layout.n_acc_s
+            self.acc[b1:(b1 + self.layout.n_acc_s)] = data['acc'].T
+
+        self.n        += 1
+        self.timestamp = timestamp
+
+        if self.n == self.n_packets:
+            self.flush()
+
+    def flush(self):
+        """ Push all collected samples. """
+        if self.n == 0:
+            return
+
+        if self.timestamp:
+            ts_ecg = self.timestamp - PACKET_DURATION / self.layout.n_ecg_s if self.layout.n_ecg_s else 0.0
+            ts_acc = self.timestamp - PACKET_DURATION / self.layout.n_acc_s if self.layout.n_acc_s else 0.0
+        else:
+            ts_ecg = ts_acc = 0.0
+
+        if self.outlet_ecg is not None:
+            self.outlet_ecg.push_chunk(self.ecg[0:(self.n * self.layout.n_ecg_s)], ts_ecg)
+
+        if self.outlet_acc is not None:
+            self.outlet_acc.push_chunk(self.acc[0:(self.n * self.layout.n_acc_s)], ts_acc)
+
+        self.n = 0
+
+
+# Lost packets are not filled in for gaps longer than this (5 minutes)
+MAX_GAP_FILL = 1500
+
+# Put into the decoder queue after reconnecting to the device
+STREAM_RESTART = object()
+
+# Longest time (in seconds) a read from a device waits for data
+READ_TIMEOUT = 0.5
+
+
+class DecoderStage(Stage):
+    """ Split the data read from a Faros device into packets, check and
+        decode them, and pass the decoded packets on to the sink queue.
+
+        Each item is a tuple (buffer, number of bytes, arrival time).
+        Buffers are returned to the pool after use. If recorder (a
+        CaptureWriter) is given, all valid packets are written to it.
+    """
+    def __init__(self, layout, queue, sink_queue, pool, framer, counter, clock, recorder = None):
+        Stage.__init__(self, 'faros-decoder', queue)
+        self.layout     = layout
+        self.sink_queue = sink_queue
+        self.pool       = pool
+        self.framer     = framer
+        self.counter    = counter
+        self.clock      = clock
+        self.recorder   = recorder
+
+        # header flags and arrival time of the latest packet
+        self.flag         = None
+        self.arrival_time = None
+
+        # set after reconnecting, until the first packet has arrived
+        self.restarted      = False
+        self.restart_time   = None
+        self.reconnect_lost = 0
+
+    def process(self, item):
+        if item is STREAM_RESTART:
+            # a partial packet from the old connection is of no use
+            self.framer.clear()
+            self.restarted    = True
+            self.restart_time = local_clock()
+            return
+
+        buf, n, arrival_time = item
+
+        for packet in self.framer.feed(buf, n):
+            data          = decode_packets(packet, self.layout).copy()[0]
+            packet_number = int(data['packet_number'])
+            self.flag     = int(data['flag'])
+
+            if self.recorder is not None:
+                self.recorder.write(packet, packet_number, arrival_time)
+
+            if self.restarted:
+                gap = self.report_restart(packet_number)
+            else:
+                gap = self.counter.update(packet_number)
+
+            if gap < 0:
+                continue
+
+            self.clock.update(packet_number, arrival_time)
+
+            if gap > 0:
+                gap_timestamp = self.clock.packet_time((packet_number - 1) & 0xFFFFFFFF)
+            else:
+                gap_timestamp = 0.0
+
+            self.sink_queue.put((data, self.clock.packet_time(packet_number), gap, gap_timestamp, arrival_time))
+
+        self.arrival_time = arrival_time
+        self.pool.put(buf)
+
+    def report_restart(self, packet_number):
+        """ Register the first packet after reconnecting and report the
+            packets lost while reconnecting. If the device has restarted
+            its packet numbering, the packet counter and clock are
+            restarted, so that the packet is not counted as a duplicate
+            or out of order. Returns the gap to use for the packet.
+        """
+        self.restarted = False
+        if self.counter.is_old(packet_number):
+            print("Packet numbering restarted after reconnecting.")
+            self.counter.restart()
+            self.clock.restart()
+            return self.counter.update(packet_number)
+
+        gap = self.counter.update(packet_number)
+        self.reconnect_lost += gap
+        print("Stream resumed after {0} lost packets ({1:.1f} s).".format(gap, gap * PACKET_DURATION))
+        return gap
+
+    def finish(self):
+        if self.recorder is not None:
+            self.recorder.close()
+        self.sink_queue.put(END_OF_STREAM, force = True)
+
+
+class SinkStage(Stage):
+    """ Push decoded packets to the LSL outlets. The time from receiving
+        a packet to pushing it is recorded in the histogram latency.
+        dtype is the channel format of the ECG and accelerometer outlets.
+    """
+    def __init__(self, layout, queue,
+                 outlet_ecg,
+                 outlet_acc,
+                 outlet_marker,
+                 outlet_rr,
+                 outlet_temp,
+                 fill_value,
+                 batcher,
+                 dtype = np.int16):
+        Stage.__init__(self, 'faros-sink', queue)
+        self.layout        = layout
+        self.fill_value    = fill_value
+        self.dtype         = dtype
+        self.batcher       = batcher
+        self.latency       = Histogram()
+
+        # the packet number of the latest packet pushed
+        self.packet_number = None
+
+        self.outlet_ecg    = outlet_ecg
+        self.outlet_acc    = outlet_acc
+        self.outlet_marker = outlet_marker
+        self.outlet_rr     = outlet_rr
+        self.outlet_temp   = outlet_temp
+
+    def process(self, item):
+        data, timestamp, gap, gap_timestamp, arrival_time = item
+
+        # a chunk must not span a gap, including packets dropped from a
+        # full queue, as LSL derives the timestamps of its samples from
+        # the last one
+        packet_number = int(data['packet_number'])
+        if self.batcher is not None:
+            if (self.packet_number is not None) and (packet_number != ((self.packet_number + 1) & 0xFFFFFFFF)):
+                self.batcher.flush()
+        self.packet_number = packet_number
+
+        if (gap > 0) and (self.fill_value is not None) and (gap <= MAX_GAP_FILL):
+            push_gap(gap, self.layout, self.fill_value, self.outlet_ecg, self.outlet_acc,
+                     timestamp = gap_timestamp, dtype = self.dtype)
+
+        if self.batcher is None:
+            push_data(data          = data,
+                      layout        = self.layout,
+
+                      outlet_ecg    = self.outlet_ecg,
+                      outlet_acc    = self.outlet_acc,
+                      outlet_marker = self.outlet_marker,
+                      outlet_rr     = self.outlet_rr,
+                      outlet_temp   = self.outlet_temp,
+
+                      timestamp     = timestamp)
+        else:
+            push_data(data          = data,
+                      layout        = self.layout,
+
+                      outlet_marker = self.outlet_marker,
+                      outlet_rr     = self.outlet_rr,
+                      outlet_temp   = self.outlet_temp,
+
+                      timestamp     = timestamp)
+            self.batcher.add(data, timestamp)
+
+        self.latency.observe(local_clock() - arrival_time)
+
+    def finish(self):
+        if self.batcher is not None:
+            self.batcher.flush()
 
 
 class StreamerThread(threading.Thread):
     """ Read data from a Faros device and stream the data using
         the Lab Streaming Layer (LSL).
+
+        The work is split into three threads connected by bounded
+        queues holding at most queue_size items: this thread only
+        reads from the socket, a DecoderStage checks and decodes the
+        packets and a SinkStage pushes the data to LSL. queue_policy
+        ('block', 'drop-oldest' or 'drop') decides what happens when
+        a queue is full.
+
+        If fill_gaps is 'zero' or 'nan', the ECG and accelerometer
+        samples of lost packets are replaced with zeros or NaNs.
+        NaNs require float32 outlets.
+
+        If packets_per_push is larger than one, the ECG and accelerometer
+        samples of that many packets are pushed to LSL as one chunk.
+
+        If recorder (a CaptureWriter) is given, the raw packets are
+        also written into a capture file.
+
+        If status_outlet is given, a StatusThread (see metrics) pushes
+        the streaming status to it.
+
+        If profiler (see profiling.Profiler) is given, the time spent
+        in each stage is recorded.
+
+        If offline is True, the device is known to be in offline mode
+        (see open_device) and is not told to stop streaming before
+        starting.
+
+        If reconnect is given, a lost connection is reestablished by
+        calling reconnect(), which should return a new socket
+        connected to the device. Reconnecting is retried with
+        exponential backoff (up to max_backoff seconds between
+        attempts). The connection is considered lost if no data
+        arrives for stall_timeout seconds. The LSL outlets are kept,
+        so the streams continue after reconnecting.
     """
     def __init__(self, stream_data,
                  faros_socket,
-                 packet_size,
-
-                 p_header,
-                 p_ecg,
-                 p_acc,
-                 p_marker,
-                 p_rr,
-                 p_temp,
-                 
+                 layout,
+
                  outlet_ecg,
                  outlet_acc,
                  outlet_marker,
                  outlet_rr,
-                 outlet_temp):
+                 outlet_temp,
+
+                 fill_gaps        = None,
+                 packets_per_push = 1,
+                 queue_size       = 64,
+                 queue_policy     = 'block',
+                 device_name      = None,
+                 recorder         = None,
+                 status_outlet    = None,
+                 profiler         = None,
+                 offline          = False,
+                 reconnect        = None,
+                 stall_timeout    = 5.0,
+                 max_backoff      = 30.0):
         
         threading.Thread.__init__(self)
+        self.offline       = offline
+        self.reconnect     = reconnect
+        self.stall_timeout = stall_timeout
+        self.max_backoff   = max_backoff
+        self.reconnects    = 0
+        self.last_read     = None
+        self.device_name   = device_name
+        self.status_outlet = status_outlet
         self.stream_data  = stream_data
         self.faros_socket = faros_socket
-        self.packet_size  = packet_size
+        self.layout       = layout
+        self.framer       = PacketFramer(layout)
+        self.counter      = PacketCounter()
+        self.clock        = PacketClock()
+        self.read_time    = 0.0
 
-        self.p_header     = p_header
-        self.p_ecg        = p_ecg
-        self.p_acc        = p_acc
-        self.p_marker     = p_marker
-        self.p_rr         = p_rr
-        self.p_temp       = p_temp
+        if fill_gaps == 'nan':
+            fill_value = np.nan
+        elif fill_gaps == 'zero':
+            fill_value = 0
+        else:
+            fill_value = None
 
-        self.outlet_ecg    = outlet_ecg
-        self.outlet_acc    = outlet_acc
-        self.outlet_marker = outlet_marker
-        self.outlet_rr     = outlet_rr
-        self.outlet_temp   = outlet_temp
+        # the channel format of the ECG and accelerometer outlets
+        if fill_gaps == 'nan':
+            dtype = np.float32
+        else:
+            dtype = np.int16
+
+        if packets_per_push > 1:
+            batcher = PacketBatcher(layout, packets_per_push, outlet_ecg, outlet_acc, dtype)
+        else:
+            batcher = None
+
+        # Buffers for the data read from the socket, each holding one packet
+        self.pool = BoundedQueue(queue_size + 2)
+        for i in range(queue_size + 2):
+            self.pool.put(bytearray(layout.size))
+
+        decoder_queue = BoundedQueue(queue_size, queue_policy, on_drop = lambda item: self.pool.put(item[0]))
+        sink_queue    = BoundedQueue(queue_size, queue_policy)
+
+        self.decoder = DecoderStage(layout, decoder_queue, sink_queue, self.pool,
+                                    self.framer, self.counter, self.clock, recorder)
+        self.sink    = SinkStage(layout, sink_queue,
+                                 outlet_ecg,
+                                 outlet_acc,
+                                 outlet_marker,
+                                 outlet_rr,
+                                 outlet_temp,
+                                 fill_value,
+                                 batcher,
+                                 dtype)
+
+        self.profiler = profiler
+        if profiler is not None:
+            profiler.instrument(self)
 
     def run(self):
+        self.start_streaming()
+
+        while (self.stream_data):
+            if self.read():
+                continue
+            if (not self.stream_data) or (self.reconnect is None) or (not self.reconnect_device()):
+                break
+
+        self.end_stream()
+
+    def start_streaming(self):
+        """ Start the decoding and LSL threads and put the device
+            into online mode.
+        """
+        self.start_stages()
+        self.go_online()
+
+    def go_online(self):
+        """ Put the device into online mode. """
+        self.recv_into = get_recv_into(self.faros_socket)
+        if self.profiler is not None:
+            self.recv_into = self.profiler.timed('recv', self.recv_into)
+
+        # the device is already offline after open_device
+        if self.offline:
+            res = send_command(self.faros_socket, "wbaom7", 7)
+        else:
+            res = send_commands(self.faros_socket, [['wbaoms', 7, True],
+                                                    ['wbaom7', 7, True]])
+
+        # reads time out, so that stopping is noticed even when the
+        # device sends nothing
+        self.faros_socket.settimeout(min(READ_TIMEOUT, self.stall_timeout))
+        self.last_read = time.time()
+
+    def reconnect_device(self):
+        """ Reconnect to the device after the connection was lost and
+            put it back into online mode. Returns False if streaming was
+            stopped or reconnecting failed for good.
+        """
+        print("Connection to {0} lost. Reconnecting.".format(self.device_name))
+        try:
+            self.faros_socket.close()
+        except OSError:
+            pass
+
+        delay = 1.0
+        while self.stream_data:
+            try:
+                self.faros_socket = self.reconnect()
+                self.offline      = True
+                if not self.stream_data:
+                    # stopped while reconnecting, the device is offline
+                    break
+                self.go_online()
+                break
+            except OSError as e:
+                print("Reconnecting to {0} failed ({1}), retrying in {2:.0f} s.".format(self.device_name, e, delay))
+            except Exception as e:
+                print_error("Cannot reconnect to {0}: {1}".format(self.device_name, e))
+                return False
+
+            t_end = time.time() + delay
+            while self.stream_data and (time.time() < t_end):
+                time.sleep(0.1)
+            delay = min(2 * delay, self.max_backoff)
+
+        if not self.stream_data:
+            return False
+
+        self.reconnects += 1
+        self.decoder.queue.put(STREAM_RESTART, force = True)
+        print("Reconnected to {0}.".format(self.device_name))
+        return True
+
+    def start_stages(self):
+        """ Start the decoding and LSL threads. """
         self.stream_data = True
 
-        ps        = self.packet_size['ps']
-        read_size = 300
-        np        = 0
-        data      = b''
+        self.decoder.start()
+        self.sink.start()
 
-        command = "wbaoms"
-        res     = send_command(self.faros_socket, command, 7)
+    def read(self):
+        """ Read data from the device and pass it on to the decoder.
+            Returns False if the connection was closed or failed, or
+            has stalled when reconnecting.
+        """
+        buf = self.pool.get()
+        t0  = time.perf_counter()
+        try:
+            n = self.recv_into(buf)
+        except socket.timeout:
+            n = None
+        except OSError:
+            n = 0
+        self.read_time += time.perf_counter() - t0
 
-        command = "wbaom7"
-        res     = send_command(self.faros_socket, command, 7)
+        if not n:
+            self.pool.put(buf)
+            if n is None:
+                # no data yet: the connection is lost only if it has
+                # stalled and can be reestablished
+                return (self.reconnect is None) or (time.time() - self.last_read < self.stall_timeout)
+            return False
 
-        p_crc = Struct('crc' /  Array(1, Int16sl))
+        self.last_read = time.time()
 
-        self.faros_socket.setblocking(True)
+        self.decoder.queue.put((buf, n, local_clock()))
+        return True
 
-        while (self.stream_data):
-            data += self.faros_socket.recv(read_size)
-            
-            if len(data) >= ps:
-
-                packet    = data[0:ps]
-                data      = data[ps:]
-                signature = packet[0:3]
-                
-                try:
-                    crc_1     = p_crc.parse(packet[-2:])['crc'][0]
-                    crc_2     = crc16.crc16xmodem(packet[:-2])
-                except TypeError:
-                    crc_1 = 0
-                    crc_2 = 1
-
-                if (signature == b'MEP') & (crc_1 == crc_2):
-
-                    unpack_data(packet        = packet,
-                                packet_size   = self.packet_size,
-
-                                p_header      = self.p_header,
-                                p_ecg         = self.p_ecg,
-                                p_acc         = self.p_acc,
-                                p_marker      = self.p_marker,
-                                p_rr          = self.p_rr,
-                                p_temp        = self.p_temp,
-
-                                outlet_ecg    = self.outlet_ecg,
-                                outlet_acc    = self.outlet_acc,
-                                outlet_marker = self.outlet_marker,
-                                outlet_rr     = self.outlet_rr,
-                                outlet_temp   = self.outlet_temp)
-                    # np += 1
+    def end_stream(self):
+        """ Tell the decoding and LSL threads that the stream has ended. """
+        self.decoder.queue.put(END_OF_STREAM, force = True)
+
+    def get_statistics(self):
+        """ Return the packet and pipeline statistics of the stream. """
+        decoder = self.decoder.get_statistics()
+        sink    = self.sink.get_statistics()
+
+        out = OrderedDict()
+        out['device']            = self.device_name
+        out['packets']           = self.counter.packets
+        out['lost_packets']      = self.counter.lost_packets
+        out['duplicate_packets'] = self.counter.duplicate_packets
+        out['reordered_packets'] = self.counter.reordered_packets
+        out['crc_errors']        = self.framer.crc_errors
+        out['resyncs']           = self.framer.resyncs
+        out['skipped_bytes']     = self.framer.skipped_bytes
+        out['clock_drift_ppm']   = self.clock.get_drift()
+        out['reconnects']        = self.reconnects
+        out['reconnect_lost']    = self.decoder.reconnect_lost
+
+        flag = self.decoder.flag
+        out['battery_high']      = int(bool(flag & FLAG_BATTERY_H)) if flag is not None else None
+        out['battery_low']       = int(bool(flag & FLAG_BATTERY_L)) if flag is not None else None
+        if self.decoder.arrival_time is not None:
+            out['packet_age']    = local_clock() - self.decoder.arrival_time
+        else:
+            out['packet_age']    = None
+
+        out['read_time']         = self.read_time
+        out['decode_time']       = decoder['busy_time']
+        out['decode_queue']      = decoder['depth']
+        out['decode_queue_max']  = decoder['max_depth']
+        out['decode_dropped']    = decoder['dropped']
+        out['push_time']         = sink['busy_time']
+        out['push_queue']        = sink['depth']
+        out['push_queue_max']    = sink['max_depth']
+        out['push_dropped']      = sink['dropped']
+        return(out)
+
+    def go_offline(self):
+        """ Tell the device to stop streaming. """
+        try:
+            send_command(self.faros_socket, "wbaoms", 0)
+        except OSError:
+            pass
+
+    def stop(self, timeout = 2.0):
+        """ Stop streaming and wait (at most timeout seconds for each
+            thread) for the reading, decoding and LSL threads to finish,
+            so that the data already read is pushed.
+        """
+        self.stream_data = False
+        faros_socket     = self.faros_socket
+        self.go_offline()
+        if self.is_alive():
+            self.join(timeout)
+        if self.faros_socket is not faros_socket:
+            # reconnected while stopping
+            self.go_offline()
+        self.decoder.join(timeout)
+        self.sink.join(timeout)
+
+
+class MultiStreamerThread(threading.Thread):
+    """ Stream data from several Faros devices using one thread for
+        reading all devices.
+
+        streamers is a list of StreamerThreads, which are not started
+        themselves: this thread waits for data on all sockets using a
+        selector and reads each device when it has data available.
+        Decoding and pushing to LSL is still done in separate threads
+        for each device. Devices with a reconnect function (see
+        StreamerThread) are reconnected in a separate thread, while
+        the other devices keep streaming.
+    """
+    def __init__(self, streamers):
+        threading.Thread.__init__(self)
+        self.streamers   = streamers
+        self.stream_data = False
+        self.reconnected = BoundedQueue(len(streamers) + 1)
+
+    def run(self):
+        self.stream_data = True
+
+        selector = selectors.DefaultSelector()
+        for streamer in self.streamers:
+            streamer.start_streaming()
+            selector.register(streamer.faros_socket, selectors.EVENT_READ, streamer)
+
+        active = set(self.streamers)
+        while self.stream_data and active:
+            lost = []
+            for key, mask in selector.select(timeout = 1.0):
+                streamer = key.data
+                if not streamer.read():
+                    lost.append(streamer)
+
+            # stalled connections
+            now = time.time()
+            for key in selector.get_map().values():
+                streamer = key.data
+                if (streamer.reconnect is not None) and (now - streamer.last_read > streamer.stall_timeout):
+                    if streamer not in lost:
+                        lost.append(streamer)
+
+            for streamer in lost:
+                selector.unregister(streamer.faros_socket)
+                if streamer.reconnect is None:
+                    streamer.end_stream()
+                    active.discard(streamer)
+                else:
+                    threading.Thread(target = self.reconnect_streamer, args = (streamer,), daemon = True).start()
+
+            while len(self.reconnected) > 0:
+                streamer, ok = self.reconnected.get()
+                if ok and self.stream_data:
+                    selector.register(streamer.faros_socket, selectors.EVENT_READ, streamer)
                 else:
-                    while True:
-                        tmp = self.faros_socket.recv(read_size)
-                        if tmp[0:3] == b'MEP':
-                            data = tmp
-                            break
+                    streamer.end_stream()
+                    active.discard(streamer)
 
+        selector.close()
 
-    def stop(self):
+        for streamer in active:
+            streamer.end_stream()
+
+    def reconnect_streamer(self, streamer):
+        self.reconnected.put((streamer, streamer.reconnect_device()))
+
+    def stop(self, timeout = 2.0):
+        """ Stop streaming from all devices and wait (at most timeout
+            seconds) for the data already read to be pushed.
+        """
         self.stream_data = False
-        command = "wbaoms"
-        send_command(self.faros_socket, command, 0)
+        sockets          = []
+        for streamer in self.streamers:
+            streamer.stream_data = False
+            sockets.append(streamer.faros_socket)
+            streamer.go_offline()
+
+        self.join(timeout)
+        for streamer, faros_socket in zip(self.streamers, sockets):
+            if streamer.faros_socket is not faros_socket:
+                # reconnected while stopping
+                streamer.go_offline()
+            streamer.decoder.join(timeout)
+            streamer.sink.join(timeout)
+
+    def get_statistics(self):
+        """ Return the statistics of each device as a list. """
+        return [streamer.get_statistics() for streamer in self.streamers]
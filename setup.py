@@ -12,8 +12,13 @@ setup(name='faros-streamer',
       include_package_data=False,
       install_requires = ['pylsl>=1.10.4',
                           'pybluez>=0.22',
-                          'construct>=2.8.0',
-                          'crc16>=0.1.1'],
+                          'numpy>=1.9.0'],
+      extras_require = {'crc16' : ['crc16>=0.1.1'],
+                        'hdf5'  : ['h5py'],
+                        'serial' : ['pyserial']},
       entry_points={"console_scripts":
-                    ["faros = faros_streamer.streamer:faros_cli"]}
+                    ["faros = faros_streamer.streamer:faros_cli",
+                     "faros-simulator = faros_streamer.simulator:simulator_cli",
+                     "faros-benchmark = faros_streamer.benchmark:benchmark_cli",
+                     "faros-decode = faros_streamer.decode:decode_cli"]}
 )
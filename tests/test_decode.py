@@ -0,0 +1,148 @@
+# This file is part of Faros Streamer.
+#
+# Copyright 2015
+# Andreas Henelius <andreas.henelius@ttl.fi>,
+# Finnish Institute of Occupational Health
+#
+# This code is released under the MIT License
+# http://opensource.org/licenses/mit-license.php
+#
+# Please see the file LICENSE for details.
+
+import struct
+
+import numpy as np
+import pytest
+
+from faros_streamer.libfaros import *
+
+# -------------------------------------------------------------------------------
+# The ECG and accelerometer data of a packet are stored channel by
+# channel (all samples of the first channel come first), which these
+# tests pin with hand-built packets.
+# -------------------------------------------------------------------------------
+
+SETTINGS = [mode_to_str(ecg_n = '1', ecg_fs = '250', acc_fs = '25'),
+            mode_to_str(ecg_n = '3', ecg_fs = '1000', rr = '1', acc_fs = '100', temp = '1'),
+            mode_to_str(ecg_n = '1', ecg_fs = '500', rr = '1', acc_fs = '100')]
+
+
+def ecg_value(packet_number, channel, sample):
+    return 1000 * channel + 200 * (packet_number % 4) + sample
+
+
+def acc_value(packet_number, channel, sample):
+    return -(1000 * channel + 200 * (packet_number % 4) + sample + 1)
+
+
+def build_packet(layout, packet_number, marker = 0, rr = 0, temp = 0):
+    """ Build a packet without using the dtype of the layout. """
+    data  = b'MEP'
+    data += struct.pack('<BI', FLAG_RR_IN_PACKET if layout.n_rr_s else 0, packet_number)
+    for c in range(layout.n_ecg_c):
+        data += struct.pack('<{0}h'.format(layout.n_ecg_s),
+                            *[ecg_value(packet_number, c, s) for s in range(layout.n_ecg_s)])
+    for c in range(3):
+        data += struct.pack('<{0}h'.format(layout.n_acc_s),
+                            *[acc_value(packet_number, c, s) for s in range(layout.n_acc_s)])
+    data += struct.pack('<h', marker)
+    if layout.n_rr_s:
+        data += struct.pack('<h', rr)
+    if layout.n_temp_s:
+        data += struct.pack('<h', temp)
+    data += b'\x00' * (layout.size - 2 - len(data))
+    data += struct.pack('<H', crc16xmodem(data))
+    return data
+
+
+@pytest.mark.parametrize('settings', SETTINGS)
+def test_to_samples(settings):
+    layout = PacketLayout(unpack_settings('wba' + settings))
+    packet = build_packet(layout, 0)
+    assert len(packet) == layout.size
+
+    data = decode_packets(packet, layout)[0]
+    ecg  = to_samples(data['ecg'])
+    acc  = to_samples(data['acc'])
+
+    assert ecg.shape == (layout.n_ecg_s, layout.n_ecg_c)
+    assert acc.shape == (layout.n_acc_s, 3)
+    assert ecg.flags['C_CONTIGUOUS']
+    assert acc.flags['C_CONTIGUOUS']
+
+    for s in range(layout.n_ecg_s):
+        for c in range(layout.n_ecg_c):
+            assert ecg[s, c] == ecg_value(0, c, s)
+    for s in range(layout.n_acc_s):
+        for c in range(3):
+            assert acc[s, c] == acc_value(0, c, s)
+
+
+@pytest.mark.parametrize('settings', SETTINGS)
+def test_decode_packets(settings):
+    layout  = PacketLayout(unpack_settings('wba' + settings))
+    packets = build_packet(layout, 7, marker = 1, rr = 812, temp = 2000) + build_packet(layout, 8)
+
+    data = decode_packets(packets, layout)
+    assert len(data) == 2
+    assert list(data['sig']) == [b'MEP', b'MEP']
+    assert list(data['packet_number']) == [7, 8]
+    assert list(data['marker']) == [1, 0]
+    if layout.n_rr_s:
+        assert data['rr'][0] == 812
+    if layout.n_temp_s:
+        assert data['temp'][0] == 2000
+    assert all(crc16xmodem(packets[i * layout.size:((i + 1) * layout.size - 2)]) == data['crc'][i] for i in range(2))
+
+    expected_ecg = np.array([[[ecg_value(n, c, s) for c in range(layout.n_ecg_c)] for s in range(layout.n_ecg_s)] for n in [7, 8]])
+    expected_acc = np.array([[[acc_value(n, c, s) for c in range(3)] for s in range(layout.n_acc_s)] for n in [7, 8]])
+    for i in range(2):
+        np.testing.assert_array_equal(to_samples(data[i]['ecg']), expected_ecg[i])
+        np.testing.assert_array_equal(to_samples(data[i]['acc']), expected_acc[i])
+
+
+class ChunkOutlet(object):
+    def __init__(self):
+        self.chunks = []
+
+    def push_chunk(self, x, timestamp = 0.0):
+        self.chunks.append(np.array(x))
+
+    def push_sample(self, x, timestamp = 0.0):
+        self.chunks.append(np.array([x]))
+
+
+def test_push_data():
+    layout  = PacketLayout(unpack_settings('wba' + SETTINGS[1]))
+    data    = decode_packets(build_packet(layout, 3), layout)[0]
+    outlets = [ChunkOutlet() for i in range(5)]
+    push_data(data, layout, *outlets)
+
+    ecg, acc = outlets[0].chunks[0], outlets[1].chunks[0]
+    assert ecg.shape == (layout.n_ecg_s, layout.n_ecg_c)
+    assert acc.shape == (layout.n_acc_s, 3)
+    assert list(ecg[1]) == [ecg_value(3, c, 1) for c in range(layout.n_ecg_c)]
+    assert list(acc[1]) == [acc_value(3, c, 1) for c in range(3)]
+
+
+@pytest.mark.parametrize('offset', [1, 50])
+def test_framer_resync(offset):
+    # signatures in the data of a packet are not counted as checksum errors
+    layout  = PacketLayout(unpack_settings('wba' + SETTINGS[0]))
+    packets = []
+    for i in range(6):
+        packet = bytearray(build_packet(layout, i))
+        for b in [layout.ecg.start + 2, layout.ecg.stop - 10, layout.acc.start + 4]:
+            packet[b:(b + 3)] = b'MEP'
+        packet[-2:] = struct.pack('<H', crc16xmodem(bytes(packet[:-2])))
+        packets.append(packet)
+
+    stream = bytearray(b''.join(packets))
+    stream[2 * layout.size + offset] ^= 0xFF
+
+    framer = PacketFramer(layout)
+    data   = [decode_packets(p, layout)[0] for p in framer.feed(stream, len(stream))]
+    assert [int(x['packet_number']) for x in data] == [0, 1, 3, 4, 5]
+    assert framer.crc_errors == (1 if offset > 2 else 0)
+    assert framer.resyncs == 1
+    assert framer.skipped_bytes == layout.size